@@ -15,19 +15,80 @@ from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (QgsProcessing,
                        QgsFeatureSink,
                        QgsRasterLayer,
+                       QgsApplication,
+                       QgsTask,
+                       QgsProject,
+                       QgsCoordinateTransform,
+                       QgsProcessingContext,
+                       QgsProcessingFeedback,
                        QgsProcessingException,
                        QgsProcessingAlgorithm,
                        QgsProcessingParameterRasterLayer,
                        QgsProcessingParameterFeatureSource,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterBand,
                        QgsProcessingOutputBoolean)
 from qgis import processing
+from qgis.utils import iface
+import numpy as np
+import os
+import sys
 
+# les modules partagés sont à côté des scripts, dossier que QGIS n'ajoute pas à sys.path
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+if SCRIPT_DIR not in sys.path:
+    sys.path.insert(0, SCRIPT_DIR)
+from rasterTools import HistogramEngine, IntermediateStorage, dataBands
 
-class EgalisationColorimetrique(QgsProcessingAlgorithm):
+# références Python des tâches en cours, sans quoi elles seraient détruites
+# par le ramasse-miettes avant la fin de leur exécution
+refinement_tasks = []
+
+class RefinementTask(QgsTask):
+    """
+    Background task computing the full resolution stretch after a preview,
+    the result replacing the preview values once the task is finished.
+    """
+
+    def __init__(self, algorithm, layer_id, parameters):
+        super().__init__('Egalisation colorimétrique pleine résolution', QgsTask.CanCancel)
+        self.algorithm = algorithm
+        # la couche d'un chemin appartient au contexte de l'algorithme, détruit
+        # avant la fin de la tâche : seule la couche du projet est mise à jour
+        self.layer_id = layer_id
+        self.parameters = parameters
+        self.stretch = None
+
+    def run(self):
+        context = QgsProcessingContext()
+        context.setProject(QgsProject.instance())
+        feedback = QgsProcessingFeedback()
+        feedback.progressChanged.connect(self.setProgress)
+        try:
+            self.stretch = self.algorithm.computeFullStretch(self.parameters, context, feedback, self)
+        finally:
+            self.algorithm.cleanIntermediates(feedback)
+        return self.stretch is not None
+
+    def finished(self, result):
+        source = QgsProject.instance().mapLayer(self.layer_id)
+        if result and source is not None:
+            self.algorithm.applyStretch(source, self.stretch)
+        refinement_tasks.remove(self)
+
+
+class EgalisationColorimetrique(IntermediateStorage, QgsProcessingAlgorithm):
 
     INPUT = 'INPUT'
     REFERENCE = 'REFERENCE'
     MASK = 'MASK'
+    PREVIEW = 'PREVIEW'
+    BANDS = 'BANDS'
+    PREVIEW_SAMPLE = 250000
+    
+    def __init__(self):
+        super().__init__()
+        self.intermediates = []
 
     def tr(self, string):
         return QCoreApplication.translate('Processing', string)
@@ -59,6 +120,17 @@ class EgalisationColorimetrique(QgsProcessingAlgorithm):
             )
         )
         
+        self.addParameter(
+            QgsProcessingParameterBand(
+                self.BANDS,
+                self.tr('Bandes rouge, verte et bleue (celles du style par défaut)'),
+                None,
+                self.INPUT,
+                optional=True,
+                allowMultiple=True
+            )
+        )
+        
         self.addParameter(
             QgsProcessingParameterRasterLayer(
                 self.REFERENCE,
@@ -73,6 +145,14 @@ class EgalisationColorimetrique(QgsProcessingAlgorithm):
             )
         )
         
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.PREVIEW,
+                self.tr("Aperçu rapide sur l'emprise de la carte, puis calcul complet en tâche de fond"),
+                defaultValue = False
+            )
+        )
+        
         self.addOutput(
             QgsProcessingOutputBoolean(
                 'SUCCESS',
@@ -80,14 +160,70 @@ class EgalisationColorimetrique(QgsProcessingAlgorithm):
             )
         )
 
-    def computeHistoMatch(self, band, match_provider, ref_provider):
+    def computeHistoMatch(self, band, match_provider, ref_provider, match_extent, ref_extent, sample_size):
         
-        ref_histo = ref_provider.histogram(band,0)
-        match_histo = match_provider.histogram(band,0)
+        # sample_size > 0 : le provider GDAL lit le niveau de pyramide adapté
+        ref_histo = ref_provider.histogram(band,0,float('nan'),float('nan'),ref_extent,sample_size)
+        match_histo = match_provider.histogram(band,0,float('nan'),float('nan'),match_extent,sample_size)
+        # mêmes histogrammes indexés par valeur que le calcul pleine résolution
+        ref_vector = self.valueVector(ref_histo, 256 if ref_provider.dataTypeSize(band) == 1 else 0)
+        match_vector = self.valueVector(match_histo, 256 if match_provider.dataTypeSize(band) == 1 else 0)
+        return self.stretchFromHistograms(ref_vector, match_vector)
+    
+    def valueVector(self, histogram, length=0):
+        """
+        Returns the counts of a QGIS histogram indexed by value, from 0 to at
+        least length-1, as HistogramEngine.valueVector. QGIS bins start at
+        the band minimum, one bin per value unless the range is capped.
+        """
+        counts = np.array(histogram.histogramVector, dtype=np.int64)
+        if len(counts) == 0:
+            return np.zeros(length, dtype=np.int64)
+        step = (histogram.maximum-histogram.minimum)/max(len(counts)-1, 1)
+        values = np.rint(histogram.minimum+np.arange(len(counts))*step).astype(np.int64)
+        keep = values >= 0
+        return np.bincount(values[keep], weights=counts[keep], minlength=length).astype(np.int64)
+    
+    def getBands(self, source, parameters, context):
+        """
+        Returns the input bands stretched by the red, green and blue contrast
+        enhancements: the BANDS parameter, or the bands of the layer style.
+        """
+        bands = self.parameterAsInts(parameters, self.BANDS, context)
+        if not bands:
+            renderer = source.renderer()
+            if hasattr(renderer, 'redBand'):
+                bands = [renderer.redBand(), renderer.greenBand(), renderer.blueBand()]
+            else :
+                bands = [1, 2, 3]
+        if len(bands) != 3:
+            raise QgsProcessingException(self.tr('Trois bandes (rouge, verte, bleue) sont attendues'))
+        return bands
+    
+    def computeHistograms(self, clip_source, clip_reference, feedback, bands=(1, 2, 3)):
+        """
+        Returns the value indexed histograms of bands for both clipped
+        rasters, 8 bits histograms having 256 values as in QGIS.
+        """
+        engine = HistogramEngine(feedback=feedback)
+        histograms = []
+        for layer in (clip_reference, clip_source):
+            # ni l'alpha du découpage, ni celui d'une image RVBA
+            data_bands = dataBands(layer.source())
+            if any(band not in data_bands for band in bands):
+                raise QgsProcessingException(self.tr('Bande absente de la couche ')+layer.name())
+            partials = engine.compute(layer.source(), bands)
+            if partials is None:
+                return None
+            length = 256 if layer.dataProvider().dataTypeSize(1) == 1 else 0
+            histograms.append([engine.valueVector(partial, length) for partial in partials])
+        return histograms
+    
+    def stretchFromHistograms(self, ref_histo, match_histo):
         
-        ref_cumulhist = [sum(ref_histo.histogramVector[:x+1]) for x in range(len(ref_histo.histogramVector))]
-        match_cumulhist = [sum(match_histo.histogramVector[:x+1]) for x in range(len(match_histo.histogramVector))]
-        if len(ref_cumulhist) == 0 or len(match_cumulhist) == 0 :
+        ref_cumulhist = np.cumsum(ref_histo).tolist()
+        match_cumulhist = np.cumsum(match_histo).tolist()
+        if len(ref_cumulhist) == 0 or len(match_cumulhist) == 0 or ref_cumulhist[-1] == 0 or match_cumulhist[-1] == 0 :
             return (0,0)
             
         ref_nbpix = ref_cumulhist[-1]
@@ -134,38 +270,96 @@ class EgalisationColorimetrique(QgsProcessingAlgorithm):
     def generateClippedInput(self, parameters, context, feedback):
         
         feedback.pushInfo("......Application du mask vecteur sur l'image d'entrée")    
-        clip_result = processing.run(
-            'gdal:cliprasterbymasklayer',
-            {
-                'INPUT': parameters['INPUT'],
-                'MASK' : parameters['MASK'],
-                'NODATA' : 0,
-                'ALPHA_BAND' : True,
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            },
-            is_child_algorithm=True,
-            context=context,
-            feedback=feedback)
-            
-        return QgsRasterLayer(clip_result['OUTPUT'])
+        return self.clipRaster('clip_input', self.INPUT, parameters, context, feedback)
     
-    def generateClippedReference(self, parameters, context, feedback):
+    def generateClippedReference(self, parameters, context, feedback, clip_source):
         
         feedback.pushInfo("......Application du mask vecteur sur l'image de référence")    
-        clip_result = processing.run(
-            'gdal:cliprasterbymasklayer',
-            {
-                'INPUT': parameters['REFERENCE'],
-                'MASK' : parameters['MASK'],
-                'ALPHA_BAND' : True,
-                'NODATA' : 0,
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            },
-            is_child_algorithm=True,
-            context=context,
-            feedback=feedback)
+        return self.warpRaster('clip_reference', self.REFERENCE, clip_source, parameters, context, feedback)
+        
+    def getPreviewExtent(self, layer, mask_source):
+        """
+        Returns the part of the current map extent covered by the work zone,
+        in the layer CRS, and the number of pixels displayed by the map.
+        """
+        project = QgsProject.instance()
+        extent = mask_source.sourceExtent()
+        extent = QgsCoordinateTransform(mask_source.sourceCrs(), layer.crs(), project).transformBoundingBox(extent)
+        sample_size = self.PREVIEW_SAMPLE
+        if iface is not None and iface.mapCanvas() is not None:
+            settings = iface.mapCanvas().mapSettings()
+            canvas_extent = QgsCoordinateTransform(settings.destinationCrs(), layer.crs(), project).transformBoundingBox(settings.visibleExtent())
+            extent = extent.intersect(canvas_extent)
+            sample_size = settings.outputSize().width() * settings.outputSize().height()
+        return (extent, sample_size)
+    
+    def computePreviewStretch(self, source, reference, parameters, context, feedback):
+        
+        mask_source = self.parameterAsSource(parameters, self.MASK, context)
+        (match_extent, sample_size) = self.getPreviewExtent(source, mask_source)
+        (ref_extent, ref_sample_size) = self.getPreviewExtent(reference, mask_source)
+        if match_extent.isEmpty() or ref_extent.isEmpty():
+            feedback.reportError("L'emprise de la carte ne recoupe pas la zone de travail",True)
+            return None
+        
+        bands = self.getBands(source, parameters, context)
+        if max(bands) > reference.bandCount():
+            raise QgsProcessingException(self.tr('Bande absente de la couche ')+reference.name())
+        stretch = []
+        for band in bands:
+            (min,max) = self.computeHistoMatch(band, source.dataProvider(), reference.dataProvider(), match_extent, ref_extent, sample_size)
+            if band == bands[0] and min==0 and max ==0 :
+                feedback.reportError("Impossible de calculer l'histogramme",True)
+                return None
+            stretch.append((min,max))
+        return stretch
+    
+    def computeFullStretch(self, parameters, context, feedback, task=None):
+        
+        feedback.setProgress(5)
+        feedback.pushInfo('Début clip des images')
+        clip_source = self.generateClippedInput(parameters,context,feedback)
+        
+        feedback.setProgress(15)
+        if feedback.isCanceled() or (task is not None and task.isCanceled()):
+            return None
+            
+        clip_reference = self.generateClippedReference(parameters,context,feedback,clip_source)
+        feedback.pushInfo('Fin clip des images')
+
+        feedback.setProgress(20)
+        feedback.pushInfo('Calcul des histogrammes')
+        bands = self.getBands(self.parameterAsRasterLayer(parameters, self.INPUT, context), parameters, context)
+        histograms = self.computeHistograms(clip_source, clip_reference, feedback, bands)
+        if histograms is None:
+            return None
+        (ref_histograms, match_histograms) = histograms
+        
+        stretch = []
+        for (index, label, progress) in ((0, 'rouge', 40), (1, 'verte', 55), (2, 'bleue', 65)):
+            feedback.setProgress(progress)
+            if feedback.isCanceled() or (task is not None and task.isCanceled()):
+                return None
             
-        return QgsRasterLayer(clip_result['OUTPUT'])
+            feedback.pushInfo('Début Histo bande '+label+' ('+str(bands[index])+')')
+            (min,max) = self.stretchFromHistograms(ref_histograms[index], match_histograms[index])
+            if index == 0 and min==0 and max ==0 : 
+                feedback.reportError("Impossible de calculer l'histogramme",True)
+                return None
+            stretch.append((min,max))
+        
+        feedback.setProgress(95)
+        return stretch
+    
+    def applyStretch(self, source, stretch):
+        
+        enhancements = (source.renderer().redContrastEnhancement(),
+                        source.renderer().greenContrastEnhancement(),
+                        source.renderer().blueContrastEnhancement())
+        for (enhancement, (min,max)) in zip(enhancements, stretch):
+            enhancement.setMinimumValue(min)
+            enhancement.setMaximumValue(max)
+        source.triggerRepaint()
         
     def processAlgorithm(self, parameters, context, feedback):
         
@@ -187,53 +381,33 @@ class EgalisationColorimetrique(QgsProcessingAlgorithm):
         if reference is None:
             raise QgsProcessingException(self.invalidSourceError(parameters, self.REFERENCE))
         
-        feedback.setProgress(5)
-        feedback.pushInfo('Début clip des images')
-        clip_source = self.generateClippedInput(parameters,context,feedback)
-        
-        feedback.setProgress(15)
-        if feedback.isCanceled():
-            return {'SUCCESS': False}
+        if self.parameterAsBoolean(parameters, self.PREVIEW, context):
+            feedback.pushInfo('Calcul de l\'aperçu')
+            stretch = self.computePreviewStretch(source, reference, parameters, context, feedback)
+            if stretch is None:
+                return {'SUCCESS': False}
+            self.applyStretch(source, stretch)
             
-        clip_reference = self.generateClippedReference(parameters,context,feedback)
-        feedback.pushInfo('Fin clip des images')
-
-        match_provider = clip_source.dataProvider()
-        ref_provider = clip_reference.dataProvider()
-        
-        feedback.setProgress(20)
-        if feedback.isCanceled():
-            return {'SUCCESS': False}
-           
-        feedback.pushInfo('Début Histo bande rouge')
-        (min,max) = self.computeHistoMatch(1, match_provider, ref_provider)
-        if min==0 and max ==0 : 
-            feedback.reportError("Impossible de calculer l'histogramme",True)
-            return {'SUCCESS': False}
-        
-        source.renderer().redContrastEnhancement().setMinimumValue(min)
-        source.renderer().redContrastEnhancement().setMaximumValue(max)
+            feedback.pushInfo('Lancement du calcul pleine résolution en tâche de fond')
+            # le contexte et les couches temporaires de l'algorithme ne survivent pas
+            # à son exécution : la tâche reçoit des paramètres résolus en chemins
+            task_parameters = {
+                self.INPUT: source.source(),
+                self.REFERENCE: reference.source(),
+                self.BANDS: self.getBands(source, parameters, context),
+                self.MASK: self.parameterAsCompatibleSourceLayerPath(parameters, self.MASK, context, ['shp', 'gpkg'])
+            }
+            task = RefinementTask(self.create(), source.id(), task_parameters)
+            refinement_tasks.append(task)
+            QgsApplication.taskManager().addTask(task)
+            return {'SUCCESS': True}
         
-        feedback.setProgress(40)
-        if feedback.isCanceled():
+        try:
+            stretch = self.computeFullStretch(parameters, context, feedback)
+        finally:
+            self.cleanIntermediates(feedback)
+        if stretch is None:
             return {'SUCCESS': False}
-        
-        feedback.pushInfo('Début Histo bande verte')
-        (min,max) = self.computeHistoMatch(2, match_provider, ref_provider)
-        source.renderer().greenContrastEnhancement().setMinimumValue(min)
-        source.renderer().greenContrastEnhancement().setMaximumValue(max)
-        
-        feedback.setProgress(65)
-        if feedback.isCanceled():
-            return {'SUCCESS': False}
-        
-        feedback.pushInfo('Début Histo bande bleue')
-        (min,max) = self.computeHistoMatch(3, match_provider, ref_provider)
-        source.renderer().blueContrastEnhancement().setMinimumValue(min)
-        source.renderer().blueContrastEnhancement().setMaximumValue(max)
-        
-        feedback.setProgress(95)
-        
-        source.triggerRepaint()
+        self.applyStretch(source, stretch)
         
         return {'SUCCESS': True}
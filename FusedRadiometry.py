@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import (QgsProcessingException,
+                       QgsProcessingAlgorithm,
+                       QgsRasterFileWriter,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingParameterRasterLayer,
+                       QgsProcessingParameterFeatureSource,
+                       QgsProcessingParameterRasterDestination)
+from osgeo import gdal
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import os
+import sys
+import uuid
+
+# les modules partagés sont à côté des scripts, dossier que QGIS n'ajoute pas à sys.path
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+if SCRIPT_DIR not in sys.path:
+    sys.path.insert(0, SCRIPT_DIR)
+from rasterTools import lutFromHistograms
+
+
+class StretchStep:
+    """
+    Linear stretch of each band from (minimum, maximum) to [0, 255], as the
+    contrast enhancement of a QGIS style. Values are not rounded.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+
+    def apply(self, index, values):
+
+        (minimum, maximum) = self.bounds[index]
+        if maximum == minimum:
+            return np.where(values > minimum, 255.0, 0.0)
+        return np.clip((values.astype(np.float64)-minimum)*(255.0/(maximum-minimum)), 0, 255)
+
+
+class ScaleStep:
+    """
+    Conversion to 8 bits, rounded as gdal_translate -scale does, after an
+    optional linear scaling from (minimum, maximum) of each band.
+    """
+
+    def __init__(self, bounds=None):
+        self.bounds = bounds
+
+    def apply(self, index, values):
+
+        if self.bounds is not None:
+            values = StretchStep(self.bounds).apply(index, values)
+        return np.clip(np.rint(values), 0, 255).astype(np.uint8)
+
+
+class LutStep:
+    """
+    Table lookup of each band, as the transformation tables of the
+    histogram matching. Values beyond the table take its last value.
+    """
+
+    def __init__(self, tables):
+        self.tables = [np.asarray(table) for table in tables]
+
+    def apply(self, index, values):
+
+        table = self.tables[index]
+        return table[np.clip(np.rint(values), 0, len(table)-1).astype(np.intp)]
+
+
+class PixelPipeline:
+    """
+    Declares the operations applied to the bands of a raster, then runs
+    them in a single pass by strips of block rows: read, compute, write.
+
+    The value steps (stretch, scale, lut) are composed into one table per
+    band when the raster is an integer raster of at most 16 bits, and are
+    applied one after the other on each strip otherwise. The mask is read
+    through a warped VRT cut by the polygons, so nothing is clipped on disk.
+    """
+
+    CHUNK_ROWS = 512
+
+    def __init__(self, path, bands=(1, 2, 3), workers=None):
+        self.path = path
+        self.read_path = path
+        self.bands = bands
+        self.workers = workers or os.cpu_count() or 1
+        self.steps = []
+        self.with_alpha = False
+        self.intermediates = []
+
+    def mask(self, mask_path):
+
+        vrt = '/vsimem/fusedRadiometry_'+uuid.uuid4().hex+'.vrt'
+        self.intermediates.append(vrt)
+        ds = gdal.Warp(vrt, self.path, format='VRT', cutlineDSName=mask_path, cropToCutline=True, dstAlpha=True)
+        if ds is None:
+            raise QgsProcessingException('Échec du découpage de '+self.path)
+        ds = None
+        self.read_path = vrt
+        return self
+
+    def stretch(self, bounds):
+        self.steps.append(StretchStep(bounds))
+        return self
+
+    def scale(self, bounds=None):
+        self.steps.append(ScaleStep(bounds))
+        return self
+
+    def lut(self, tables):
+        self.steps.append(LutStep(tables))
+        return self
+
+    def alpha(self):
+        self.with_alpha = True
+        return self
+
+    def close(self):
+
+        for path in self.intermediates:
+            gdal.Unlink(path)
+        self.intermediates = []
+
+    def evaluate(self, index, values):
+
+        for step in self.steps:
+            values = step.apply(index, values)
+        return np.clip(np.rint(values), 0, 255).astype(np.uint8)
+
+    def compile(self, dtype):
+        """
+        Returns the function computing each band from the values read.
+        """
+        functions = []
+        for index in range(len(self.bands)):
+            if dtype.kind in 'ui' and dtype.itemsize <= 2:
+                info = np.iinfo(dtype)
+                table = self.evaluate(index, np.arange(info.min, info.max+1))
+                functions.append(lambda values, table=table, offset=int(info.min): table[values.astype(np.intp)-offset])
+            else:
+                functions.append(lambda values, index=index: self.evaluate(index, values))
+        return functions
+
+    def process(self, functions, row, rows):
+        """
+        Computes the bands and the validity of rows [row, row+rows). Each
+        call opens its own dataset, GDAL handles not being thread safe.
+        """
+        ds = gdal.Open(self.read_path, gdal.GA_ReadOnly)
+        width = ds.RasterXSize
+        bands = [function(ds.GetRasterBand(band).ReadAsArray(0, row, width, rows))
+                 for (function, band) in zip(functions, self.bands)]
+        first_band = ds.GetRasterBand(self.bands[0])
+        valid = None
+        if not first_band.GetMaskFlags() & gdal.GMF_ALL_VALID:
+            valid = first_band.GetMaskBand().ReadAsArray(0, row, width, rows) == 255
+            for band in bands:
+                band[~valid] = 0
+        ds = None
+        return (bands, valid)
+
+    def stream(self, consume, feedback):
+        """
+        Calls consume(row, bands, valid) on every strip, in order, while at
+        most two strips per worker are computed ahead.
+        """
+        ds = gdal.Open(self.read_path, gdal.GA_ReadOnly)
+        if ds is None:
+            raise QgsProcessingException('Impossible d\'ouvrir '+self.path)
+        block_y = ds.GetRasterBand(self.bands[0]).GetBlockSize()[1]
+        rows = max(block_y, self.CHUNK_ROWS//block_y*block_y)
+        chunks = [(row, min(rows, ds.RasterYSize-row)) for row in range(0, ds.RasterYSize, rows)]
+        functions = self.compile(ds.GetRasterBand(self.bands[0]).ReadAsArray(0, 0, 1, 1).dtype)
+        ds = None
+
+        pending = deque()
+        done = [0]
+
+        def drain(limit):
+            while len(pending) > limit:
+                if feedback.isCanceled():
+                    return False
+                (row, future) = pending.popleft()
+                (bands, valid) = future.result()
+                consume(row, bands, valid)
+                done[0] += 1
+                feedback.setProgress(int(done[0]*100/len(chunks)))
+            return True
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                for (row, rows) in chunks:
+                    pending.append((row, executor.submit(self.process, functions, row, rows)))
+                    if not drain(2*self.workers):
+                        return False
+                if not drain(0):
+                    return False
+            finally:
+                for (row, future) in pending:
+                    future.cancel()
+        return True
+
+    def histograms(self, feedback, nodata=None):
+        """
+        Returns the 256 values histograms of the bands at the end of the
+        steps declared so far, over the valid pixels, or None if canceled.
+        Values equal to nodata are left out of each band, as the 0 nodata of
+        the clips of Histogram Matching.
+        """
+        histograms = np.zeros((len(self.bands), 256), dtype=np.int64)
+
+        def consume(row, bands, valid):
+            for (index, band) in enumerate(bands):
+                histograms[index] += np.bincount((band if valid is None else band[valid]).ravel(), minlength=256)
+
+        if not self.stream(consume, feedback):
+            return None
+        if nodata is not None:
+            histograms[:, nodata] = 0
+        return histograms
+
+    def run(self, output, feedback):
+        """
+        Writes the 8 bits result to output, with an alpha band if declared.
+        Returns False if canceled.
+        """
+        ds = gdal.Open(self.read_path, gdal.GA_ReadOnly)
+        driver = gdal.GetDriverByName(QgsRasterFileWriter.driverForExtension(os.path.splitext(output)[1]) or 'GTiff')
+        options = ['TILED=YES', 'COMPRESS=DEFLATE', 'PREDICTOR=2', 'BIGTIFF=IF_SAFER'] if driver.ShortName == 'GTiff' else []
+        out = driver.Create(output, ds.RasterXSize, ds.RasterYSize, len(self.bands)+(1 if self.with_alpha else 0), gdal.GDT_Byte, options=options)
+        if out is None:
+            raise QgsProcessingException('Impossible de créer '+output)
+        out.SetGeoTransform(ds.GetGeoTransform())
+        out.SetProjection(ds.GetProjection())
+        ds = None
+        for (index, interp) in enumerate((gdal.GCI_RedBand, gdal.GCI_GreenBand, gdal.GCI_BlueBand)[:len(self.bands)]):
+            out.GetRasterBand(index+1).SetColorInterpretation(interp)
+        if self.with_alpha:
+            out.GetRasterBand(len(self.bands)+1).SetColorInterpretation(gdal.GCI_AlphaBand)
+
+        def consume(row, bands, valid):
+            for (index, band) in enumerate(bands):
+                out.GetRasterBand(index+1).WriteArray(band, 0, row)
+            if self.with_alpha:
+                alpha = np.full(bands[0].shape, 255, dtype=np.uint8) if valid is None else np.where(valid, 255, 0).astype(np.uint8)
+                out.GetRasterBand(len(self.bands)+1).WriteArray(alpha, 0, row)
+
+        complete = self.stream(consume, feedback)
+        out = None
+        return complete
+
+
+class FusedRadiometry(QgsProcessingAlgorithm):
+
+    INPUT = 'INPUT'
+    MASK = 'MASK'
+    REFERENCE = 'REFERENCE'
+    DESATURATION = 'DESATURATION'
+    SATURATION = 'SATURATION'
+    OUTPUT = 'OUTPUT'
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return FusedRadiometry()
+
+    def name(self):
+        return 'fusedRadiometry'
+
+    def displayName(self):
+        return self.tr('Fused Radiometry')
+
+    def group(self):
+        return self.tr('Satellite')
+
+    def groupId(self):
+        return 'satellite'
+
+    def shortHelpString(self):
+        return self.tr("Enchaîne en une seule lecture de l'image le découpage, l'étirement du style (Egalisation Colorimétrique), l'histogram matching sur une référence optionnelle et la conversion 8 bits avec canal alpha (To 8 Bits From Style)")
+
+    def initAlgorithm(self, config=None):
+
+        self.addParameter(
+            QgsProcessingParameterRasterLayer(
+                self.INPUT,
+                self.tr('Couche en entrée')
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.MASK,
+                self.tr('Zone de découpe'),
+                optional=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterRasterLayer(
+                self.REFERENCE,
+                self.tr('Image de référence (histogram matching)'),
+                optional=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.DESATURATION,
+                self.tr('Poucentage de désaturation'),
+                defaultValue = 1,
+                minValue = 0,
+                maxValue = 100
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.SATURATION,
+                self.tr('Poucentage de saturation'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue = 0,
+                minValue = 0,
+                maxValue = 100
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterRasterDestination(
+                self.OUTPUT,
+                self.tr('Couche en sortie')
+            )
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+
+        source = self.parameterAsRasterLayer(parameters, self.INPUT, context)
+        if source is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.INPUT))
+        reference = self.parameterAsRasterLayer(parameters, self.REFERENCE, context)
+        mask = self.parameterAsSource(parameters, self.MASK, context)
+        mask_path = None
+        if mask is not None:
+            mask_path = self.parameterAsCompatibleSourceLayerPath(parameters, self.MASK, context, ['shp', 'gpkg'], 'gpkg', feedback)
+
+        renderer = source.renderer()
+        if not hasattr(renderer, 'redContrastEnhancement') :
+            raise QgsProcessingException(self.tr("La couche n'a pas de style RVB"))
+        bounds = [(enhancement.minimumValue(), enhancement.maximumValue()) for enhancement in
+                  (renderer.redContrastEnhancement(), renderer.greenContrastEnhancement(), renderer.blueContrastEnhancement())]
+
+        pipeline = PixelPipeline(source.source())
+        pipelines = [pipeline]
+        try:
+            if mask_path is not None:
+                pipeline.mask(mask_path)
+            pipeline.stretch(bounds).scale()
+
+            if reference is not None:
+                feedback.pushInfo('Calcul des histogrammes')
+                # comme Histogram Matching, qui découpe ses entrées avec 0 en nodata
+                match_histograms = pipeline.histograms(feedback, 0)
+                ref_pipeline = PixelPipeline(reference.source())
+                pipelines.append(ref_pipeline)
+                if mask_path is not None:
+                    ref_pipeline.mask(mask_path)
+                ref_histograms = ref_pipeline.scale().histograms(feedback, 0)
+                if match_histograms is None or ref_histograms is None:
+                    return {}
+                if match_histograms.sum() == 0 or ref_histograms.sum() == 0:
+                    raise QgsProcessingException(self.tr("Impossible de calculer l'histogramme"))
+
+                pourcent_desaturation = self.parameterAsInt(parameters, self.DESATURATION, context)
+                pourcent_saturation = self.parameterAsDouble(parameters, self.SATURATION, context)
+                pipeline.lut([lutFromHistograms(ref_hist, match_hist, pourcent_desaturation, pourcent_saturation)
+                              for (ref_hist, match_hist) in zip(ref_histograms, match_histograms)])
+
+            feedback.pushInfo('Création du raster 8 bits')
+            output = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
+            if not pipeline.alpha().run(output, feedback):
+                return {}
+        finally:
+            for item in pipelines:
+                item.close()
+
+        return {'OUTPUT': output}
@@ -12,24 +12,473 @@
 """
 
 from qgis.PyQt.QtCore import QCoreApplication
-from qgis.core import (QgsProcessing,
+from qgis.core import (Qgis,
+                       QgsProcessing,
                        QgsFeatureSink,
                        QgsRectangle,
+                       QgsGeometry,
+                       QgsSpatialIndex,
+                       QgsFeatureRequest,
                        QgsRasterLayer,
                        QgsProcessingException,
                        QgsProcessingAlgorithm,
                        QgsProcessingParameterNumber,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterBand,
+                       QgsProcessingParameterEnum,
                        QgsProcessingParameterRasterLayer,
                        QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterFileDestination,
                        QgsProcessingOutputBoolean)
 from qgis import processing
-from osgeo import gdal, osr
+from osgeo import gdal, ogr, osr
+from contextlib import contextmanager, nullcontext
 import numpy as np
+import json
+import math
 import os
+import queue
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
 
+# les modules partagés sont à côté des scripts, dossier que QGIS n'ajoute pas à sys.path
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+if SCRIPT_DIR not in sys.path:
+    sys.path.insert(0, SCRIPT_DIR)
+from rasterTools import HistogramEngine, IntermediateStorage, colorInterpretations, dataBands, lutFromHistograms
+from tileQueue import createQueue
 
-class HistogramMatching(QgsProcessingAlgorithm):
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class NullProfiler:
+    """
+    Profiler used when instrumentation is disabled : every call is a no-op.
+    """
+
+    NULL_STAGE = nullcontext()
+
+    def stage(self, name, **args):
+        return self.NULL_STAGE
+
+    def addRead(self, nbytes):
+        pass
+
+    def addWritten(self, nbytes):
+        pass
+
+    def addPixels(self, npixels):
+        pass
+
+    def report(self, feedback):
+        pass
+
+    def writeProfile(self, path):
+        pass
+
+
+class StageProfiler(NullProfiler):
+    """
+    Records the duration of every stage and tile, the bytes read and written
+    and the number of remapped pixels. The profile file uses the Chrome trace
+    format (chrome://tracing, Perfetto) with the summary as an extra key.
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.totals = {}
+        self.counts = {}
+        self.events = []
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.pixels = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.totals[name] = self.totals.get(name, 0) + end - start
+                self.counts[name] = self.counts.get(name, 0) + 1
+                self.events.append({
+                    'name': name,
+                    'ph': 'X',
+                    'ts': (start - self.origin) * 1e6,
+                    'dur': (end - start) * 1e6,
+                    'pid': os.getpid(),
+                    'tid': threading.get_ident(),
+                    'args': args
+                })
+
+    def addRead(self, nbytes):
+        with self.lock:
+            self.bytes_read += nbytes
+
+    def addWritten(self, nbytes):
+        with self.lock:
+            self.bytes_written += nbytes
+
+    def addPixels(self, npixels):
+        with self.lock:
+            self.pixels += npixels
+
+    def peakMemory(self):
+        if resource is None:
+            return None
+        # ru_maxrss est en ko sous Linux, en octets sous macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    def summary(self):
+        remap = self.totals.get('remap', 0)
+        return {
+            'total': time.perf_counter() - self.origin,
+            'stages': dict((name, {'seconds': self.totals[name], 'count': self.counts[name]}) for name in self.totals),
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'pixels': self.pixels,
+            'pixels_per_second': self.pixels / remap if remap > 0 else None,
+            'peak_rss': self.peakMemory()
+        }
+
+    def report(self, feedback):
+        summary = self.summary()
+        feedback.pushInfo('Profil : durée totale '+str(round(summary['total'], 2))+' s')
+        for name in sorted(summary['stages'], key=lambda name: -summary['stages'][name]['seconds']):
+            stage = summary['stages'][name]
+            feedback.pushInfo('......'+name+' : '+str(round(stage['seconds'], 2))+' s ('+str(stage['count'])+' appels)')
+        feedback.pushInfo('......lu : '+str(round(summary['bytes_read']/1048576, 1))+' Mo, écrit : '+str(round(summary['bytes_written']/1048576, 1))+' Mo')
+        if summary['pixels_per_second'] is not None:
+            feedback.pushInfo('......débit : '+str(int(summary['pixels_per_second']))+' pixels/s')
+        if summary['peak_rss'] is not None:
+            feedback.pushInfo('......mémoire max : '+str(round(summary['peak_rss']/1048576, 1))+' Mo')
+
+    def writeProfile(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms', 'summary': self.summary()}, f)
+
+
+class TilePipeline:
+    """
+    Runs the read, remap and write steps of the tiles on three threads linked
+    by bounded queues : the next tiles are read while the current one is
+    remapped and the previous ones are compressed and written. At most depth
+    tiles wait in each queue, which caps the memory used.
+    """
+
+    def __init__(self, read, remap, write, depth, feedback):
+        self.read = read
+        self.remap = remap
+        self.write = write
+        self.read_queue = queue.Queue(maxsize=depth)
+        self.write_queue = queue.Queue(maxsize=depth)
+        self.feedback = feedback
+        self.stop = threading.Event()
+        self.errors = []
+
+    def put(self, target, item):
+        # attente interruptible : un autre thread peut avoir échoué ou été annulé
+        while not self.stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, source):
+        while True:
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                if self.stop.is_set():
+                    return None
+
+    def reader(self, tiles):
+        try:
+            for tile in tiles:
+                if self.stop.is_set() or self.feedback.isCanceled():
+                    break
+                if not self.put(self.read_queue, (tile, self.read(tile))):
+                    return
+        except Exception as e:
+            self.errors.append(e)
+            self.stop.set()
+        self.put(self.read_queue, None)
+
+    def writer(self, on_written):
+        try:
+            while True:
+                item = self.get(self.write_queue)
+                if item is None:
+                    break
+                (tile, data) = item
+                self.write(tile, data)
+                on_written(tile)
+        except Exception as e:
+            self.errors.append(e)
+            self.stop.set()
+
+    def run(self, tiles, on_written):
+        """
+        Processes the tiles, on_written being called by the writer thread
+        after each tile. Returns False if the run was cancelled.
+        """
+        reader = threading.Thread(target=self.reader, args=(tiles,))
+        writer = threading.Thread(target=self.writer, args=(on_written,))
+        reader.start()
+        writer.start()
+        try:
+            while True:
+                item = self.get(self.read_queue)
+                if item is None or self.feedback.isCanceled():
+                    break
+                (tile, data) = item
+                if not self.put(self.write_queue, (tile, self.remap(tile, data))):
+                    break
+        except Exception as e:
+            self.errors.append(e)
+            self.stop.set()
+        finally:
+            if self.feedback.isCanceled():
+                self.stop.set()
+            self.put(self.write_queue, None)
+            self.stop.set()
+            reader.join()
+            writer.join()
+        
+        if self.errors:
+            raise self.errors[0]
+        return not self.feedback.isCanceled()
+
+
+class TileMaskProvider:
+    """
+    Mask rasterized on demand, tile by tile, at the tile resolution. The
+    polygons are loaded once in the raster CRS with a spatial index; a tile
+    fully inside or outside the mask is answered without rasterization.
+    """
+
+    def __init__(self, source, crs, transform_context, feedback):
+        request = QgsFeatureRequest().setNoAttributes().setDestinationCrs(crs, transform_context)
+        self.geometries = {}
+        self.engines = {}
+        self.index = QgsSpatialIndex()
+        self.mask_extent = QgsRectangle()
+        self.mask_extent.setMinimal()
+        for feature in source.getFeatures(request):
+            if feedback.isCanceled():
+                break
+            geometry = feature.geometry()
+            if geometry.isEmpty():
+                continue
+            engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+            engine.prepareGeometry()
+            self.geometries[feature.id()] = geometry
+            self.engines[feature.id()] = engine
+            self.index.addFeature(feature)
+            self.mask_extent.combineExtentWith(geometry.boundingBox())
+
+    def extent(self):
+        return self.mask_extent
+
+    def block(self, extent, width, height):
+        """
+        Returns a (height, width) boolean array, True inside the mask.
+        """
+        tile = QgsGeometry.fromRect(extent)
+        # marge d'un pixel pour que le découpage ne crée pas de bord artificiel
+        clip_extent = extent.buffered(extent.width()/width)
+        geometries = []
+        for fid in self.index.intersects(extent):
+            engine = self.engines[fid]
+            if engine.contains(tile.constGet()):
+                return np.ones((height, width), dtype=bool)
+            if engine.intersects(tile.constGet()):
+                geometries.append(self.geometries[fid].clipped(clip_extent))
+        if not geometries:
+            return np.zeros((height, width), dtype=bool)
+
+        ds = gdal.GetDriverByName('MEM').Create('', width, height, 1, gdal.GDT_Byte)
+        ds.SetGeoTransform([extent.xMinimum(), extent.width()/width, 0, extent.yMaximum(), 0, -extent.height()/height])
+        layer = ogr.GetDriverByName('Memory').CreateDataSource('').CreateLayer('mask', None, ogr.wkbUnknown)
+        for geometry in geometries:
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetGeometryDirectly(ogr.CreateGeometryFromWkb(bytes(geometry.asWkb())))
+            layer.CreateFeature(feature)
+        gdal.RasterizeLayer(ds, [1], layer, burn_values=[255])
+        return ds.GetRasterBand(1).ReadAsArray() == 255
+
+    def writeVector(self, path, crs):
+        
+        if os.path.exists(path):
+            os.remove(path)
+        srs = osr.SpatialReference()
+        srs.ImportFromWkt(crs.toWkt())
+        ds = ogr.GetDriverByName('GPKG').CreateDataSource(path)
+        layer = ds.CreateLayer('mask', srs, ogr.wkbUnknown)
+        for geometry in self.geometries.values():
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetGeometryDirectly(ogr.CreateGeometryFromWkb(bytes(geometry.asWkb())))
+            layer.CreateFeature(feature)
+        ds = None
+
+
+class LutGrid:
+    """
+    Transformation tables computed on a coarse grid of cells covering the
+    work zone, stored as a (bands, cells, bins) array of the output type,
+    as the tables of LutStack. Each pixel is
+    remapped with the bilinear blend of the tables of the four cells whose
+    centers surround it, so that the correction varies smoothly.
+    """
+
+    STRIP = 512
+
+    def __init__(self, x0, y0, cell_size, nx, ny, luts):
+        self.x0 = x0
+        self.y0 = y0
+        self.cell_size = cell_size
+        self.nx = nx
+        self.ny = ny
+        self.luts = luts
+
+    def axis(self, centers, count):
+        position = centers / self.cell_size - 0.5
+        index0 = np.clip(np.floor(position), 0, count-1).astype(np.intp)
+        index1 = np.minimum(index0+1, count-1)
+        weight = np.clip(position-index0, 0, 1).astype(np.float32)
+        return (index0, index1, weight)
+
+    def remap(self, values, valid, extent, width, height):
+        """
+        Remaps the (bands, height, width) block covering extent. Rows are
+        processed by strips to bound the size of the index arrays.
+        """
+        bins = self.luts.shape[2]
+        pixel_x = extent.width()/width
+        pixel_y = extent.height()/height
+        (ix0, ix1, wx) = self.axis(extent.xMinimum()-self.x0+(np.arange(width)+0.5)*pixel_x, self.nx)
+        (iy0, iy1, wy) = self.axis(self.y0-extent.yMaximum()+(np.arange(height)+0.5)*pixel_y, self.ny)
+        luts = self.luts.reshape(self.luts.shape[0], -1)
+
+        bands = np.zeros((len(values), height, width), dtype=self.luts.dtype)
+        for row in range(0, height, self.STRIP):
+            rows = slice(row, min(row+self.STRIP, height))
+            top = (iy0[rows]*self.nx)[:, None]
+            bottom = (iy1[rows]*self.nx)[:, None]
+            corners = ((top+ix0[None, :])*bins, (top+ix1[None, :])*bins,
+                       (bottom+ix0[None, :])*bins, (bottom+ix1[None, :])*bins)
+            ry = wy[rows][:, None]
+            for (band, value, lut) in zip(bands, values, luts):
+                value = np.clip(value[rows].astype(np.intp), 0, bins-1)
+                (c00, c10, c01, c11) = (lut[corner+value] for corner in corners)
+                blend = (1-ry)*((1-wx)*c00+wx*c10) + ry*((1-wx)*c01+wx*c11)
+                band[rows] = np.rint(blend).astype(self.luts.dtype)
+        bands[:, ~valid] = 0
+        return bands
+
+
+class LutStack:
+    """
+    Transformation tables of all the bands stored as one (bands, bins) array
+    of the output type, uint8 or uint16, so that a (bands, rows, cols) block
+    is remapped with a single gather. Values beyond a table take its last
+    value, table values are clipped to the output type.
+    """
+
+    def __init__(self, tables, dtype=np.uint8):
+        bins = max(len(table) for table in tables)
+        self.luts = np.empty((len(tables), bins), dtype=dtype)
+        for (index, table) in enumerate(tables):
+            table = np.clip(np.asarray(table, dtype=np.int64), 0, np.iinfo(dtype).max)
+            self.luts[index, :len(table)] = table
+            self.luts[index, len(table):] = table[-1]
+        self.offsets = (np.arange(len(tables))*bins)[:, None, None]
+
+    def remap(self, values, valid):
+        
+        index = np.clip(values.astype(np.intp), 0, self.luts.shape[1]-1)
+        index += self.offsets
+        bands = np.take(self.luts, index)
+        bands[:, ~valid] = 0
+        return bands
+
+
+class VrtBuilder:
+    """
+    Writes a VRT mosaic directly from the tiles metadata, without opening
+    the tiles as gdal:buildvirtualraster does. Tiles can be added as they
+    are written, all of them sharing the pixel size, band count and type,
+    the last band being the alpha band. color_interps names the colour
+    interpretation of the other bands, Undefined by default.
+    """
+
+    def __init__(self, path, srs_wkt, pixel_x, pixel_y, nb_bands=4, data_type='Byte', color_interps=None):
+        self.path = path
+        self.srs_wkt = srs_wkt
+        self.pixel_x = pixel_x
+        self.pixel_y = pixel_y
+        self.nb_bands = nb_bands
+        self.color_interps = color_interps or ['Undefined']*(nb_bands-1)
+        self.data_type = data_type
+        self.tiles = []
+
+    def addTile(self, path, xmin, ymax, width, height, window=None):
+        """
+        Adds a tile whose upper left corner is (xmin, ymax). window, as
+        (xoff, yoff, xsize, ysize), restricts the tile to a part of the file.
+        """
+        if window is None:
+            window = (0, 0, width, height)
+        self.tiles.append((path, xmin, ymax, width, height, window))
+
+    def write(self):
+        
+        xmin = min(tile[1] + tile[5][0]*self.pixel_x for tile in self.tiles)
+        ymax = max(tile[2] - tile[5][1]*self.pixel_y for tile in self.tiles)
+        xmax = max(tile[1] + (tile[5][0]+tile[5][2])*self.pixel_x for tile in self.tiles)
+        ymin = min(tile[2] - (tile[5][1]+tile[5][3])*self.pixel_y for tile in self.tiles)
+        
+        root = ET.Element('VRTDataset', rasterXSize=str(int(round((xmax-xmin)/self.pixel_x))),
+                          rasterYSize=str(int(round((ymax-ymin)/self.pixel_y))))
+        ET.SubElement(root, 'SRS', dataAxisToSRSAxisMapping='1,2').text = self.srs_wkt
+        ET.SubElement(root, 'GeoTransform').text = ', '.join(repr(float(v)) for v in (xmin, self.pixel_x, 0, ymax, 0, -self.pixel_y))
+        
+        vrt_dir = os.path.dirname(os.path.abspath(self.path))
+        for band in range(1, self.nb_bands+1):
+            vrt_band = ET.SubElement(root, 'VRTRasterBand', dataType=self.data_type, band=str(band))
+            if band == self.nb_bands:
+                ET.SubElement(vrt_band, 'ColorInterp').text = 'Alpha'
+            else:
+                ET.SubElement(vrt_band, 'ColorInterp').text = self.color_interps[band-1]
+            for (path, tile_xmin, tile_ymax, width, height, window) in self.tiles:
+                source = ET.SubElement(vrt_band, 'SimpleSource')
+                ET.SubElement(source, 'SourceFilename', relativeToVRT='1').text = os.path.relpath(path, vrt_dir).replace(os.sep, '/')
+                ET.SubElement(source, 'SourceBand').text = str(band)
+                ET.SubElement(source, 'SourceProperties', RasterXSize=str(width), RasterYSize=str(height), DataType=self.data_type)
+                (xoff, yoff, xsize, ysize) = window
+                ET.SubElement(source, 'SrcRect', xOff=str(xoff), yOff=str(yoff), xSize=str(xsize), ySize=str(ysize))
+                ET.SubElement(source, 'DstRect',
+                              xOff=str(int(round((tile_xmin-xmin)/self.pixel_x))+xoff),
+                              yOff=str(int(round((ymax-tile_ymax)/self.pixel_y))+yoff),
+                              xSize=str(xsize), ySize=str(ysize))
+        
+        tmp_path = self.path+'.tmp'
+        ET.ElementTree(root).write(tmp_path, encoding='utf-8')
+        os.replace(tmp_path, self.path)
+
+
+class HistogramMatching(IntermediateStorage, QgsProcessingAlgorithm):
 
     INPUT = 'INPUT'
     REFERENCE = 'REFERENCE'
@@ -38,6 +487,40 @@ class HistogramMatching(QgsProcessingAlgorithm):
     SATURATION = 'SATURATION'
     DECOUPE = 'DECOUPE'
     OUTPUT = 'OUTPUT'
+    PROFILE = 'PROFILE'
+    PROFILE_FILE = 'PROFILE_FILE'
+    DISTRIBUTED = 'DISTRIBUTED'
+    LOCAL = 'LOCAL'
+    CELL_SIZE = 'CELL_SIZE'
+    MIN_CELL_PIXELS = 1000
+    QUICKLOOK = 'QUICKLOOK'
+    QUICKLOOK_RESOLUTION = 'QUICKLOOK_RESOLUTION'
+    QUICKLOOK_ONLY = 'QUICKLOOK_ONLY'
+    BANDS = 'BANDS'
+    OUTPUT_TYPE = 'OUTPUT_TYPE'
+    
+    
+    PIPELINE_DEPTH = 2
+    OUTPUT_DTYPES = (np.uint8, np.uint16)
+    GDAL_TYPES = {
+        np.uint8: gdal.GDT_Byte,
+        np.uint16: gdal.GDT_UInt16
+    }
+    BLOCK_DTYPES = {
+        Qgis.Byte: np.uint8,
+        Qgis.UInt16: np.uint16,
+        Qgis.Int16: np.int16,
+        Qgis.UInt32: np.uint32,
+        Qgis.Int32: np.int32,
+        Qgis.Float32: np.float32,
+        Qgis.Float64: np.float64
+    }
+    
+    profiler = NullProfiler()
+    
+    def __init__(self):
+        super().__init__()
+        self.intermediates = []
 
 
     def tr(self, string):
@@ -70,6 +553,17 @@ class HistogramMatching(QgsProcessingAlgorithm):
             )
         )
         
+        self.addParameter(
+            QgsProcessingParameterBand(
+                self.BANDS,
+                self.tr('Bandes à traiter (1, 2, 3 par défaut)'),
+                None,
+                self.INPUT,
+                optional=True,
+                allowMultiple=True
+            )
+        )
+        
         self.addParameter(
             QgsProcessingParameterRasterLayer(
                 self.REFERENCE,
@@ -121,6 +615,87 @@ class HistogramMatching(QgsProcessingAlgorithm):
             )
         )
         
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.OUTPUT_TYPE,
+                self.tr('Type des dalles en sortie'),
+                options=['Byte', 'UInt16'],
+                defaultValue=0
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.LOCAL,
+                self.tr('Égalisation locale (tables calculées par cellule et interpolées)'),
+                defaultValue = False
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.CELL_SIZE,
+                self.tr('Taille des cellules de l\'égalisation locale (m)'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue = 5000,
+                minValue = 1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.DISTRIBUTED,
+                self.tr('Publier les dalles dans une file de travail (exécution par histogramMatchingWorker.py)'),
+                defaultValue = False
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.PROFILE,
+                self.tr('Mesurer la durée de chaque étape'),
+                defaultValue = False
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.PROFILE_FILE,
+                self.tr('Fichier de profil (trace Chrome)'),
+                'JSON files (*.json)',
+                optional=True,
+                createByDefault=False
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.QUICKLOOK,
+                self.tr('Aperçu basse résolution (calculé avant les dalles)'),
+                'GeoTIFF files (*.tif)',
+                optional=True,
+                createByDefault=False
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.QUICKLOOK_RESOLUTION,
+                self.tr('Résolution de l\'aperçu (m)'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue = 20,
+                minValue = 0.01
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.QUICKLOOK_ONLY,
+                self.tr('Calculer uniquement l\'aperçu (sans les dalles)'),
+                defaultValue = False
+            )
+        )
+        
         self.addOutput(
             QgsProcessingOutputBoolean(
                 'SUCCESS',
@@ -131,101 +706,18 @@ class HistogramMatching(QgsProcessingAlgorithm):
     def generateClippedInput(self, parameters, context, feedback):
         
         feedback.pushInfo("......Application du mask vecteur sur l'image d'entrée")    
-        clip_result = processing.run(
-            'gdal:cliprasterbymasklayer',
-            {
-                'INPUT': parameters['INPUT'],
-                'MASK' : parameters['MASK'],
-                'NODATA' : 0,
-                'ALPHA_BAND' : True,
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            },
-            is_child_algorithm=True,
-            context=context,
-            feedback=feedback)
-            
-        return QgsRasterLayer(clip_result['OUTPUT'])
+        return self.clipRaster('clip_input', self.INPUT, parameters, context, feedback)
     
-    def generateClippedReference(self, parameters, context, feedback):
+    def generateClippedReference(self, parameters, context, feedback, clip_source):
         
         feedback.pushInfo("......Application du mask vecteur sur l'image de référence")    
-        clip_result = processing.run(
-            'gdal:cliprasterbymasklayer',
-            {
-                'INPUT': parameters['REFERENCE'],
-                'MASK' : parameters['MASK'],
-                'ALPHA_BAND' : True,
-                'NODATA' : 0,
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            },
-            is_child_algorithm=True,
-            context=context,
-            feedback=feedback)
-            
-        return QgsRasterLayer(clip_result['OUTPUT'])
+        return self.warpRaster('clip_reference', self.REFERENCE, clip_source, parameters, context, feedback)
     
     def generateFinalClip(self, parameters, context, feedback):
         
         feedback.pushInfo("......Application du mask final sur l'image d'entrée")    
-        clip_result = processing.run(
-            'gdal:cliprasterbymasklayer',
-            {
-                'INPUT': parameters['INPUT'],
-                'MASK' : parameters['DECOUPE'],
-                'ALPHA_BAND' : True,
-                'NODATA' : 0,
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            },
-            is_child_algorithm=True,
-            context=context,
-            feedback=feedback)
-            
-        return QgsRasterLayer(clip_result['OUTPUT'])
-
-    def generateTravailMask(self, parameters, context, feedback):
-        
-        feedback.pushInfo("......Création du mask de travail")    
-        mask_result = processing.run(
-            'gdal:rasterize',
-            {
-                'INPUT': parameters['MASK'],
-                'BURN' : 255,
-                'NODATA': 0,
-                'EXTENT': parameters['MASK'],
-                'UNITS' : 1,
-                'WIDTH' : 0.5,
-                'HEIGHT' : 0.5,
-                'DATA_TYPE' : 0,
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            },
-            is_child_algorithm=True,
-            context=context,
-            feedback=feedback)
-            
-        return QgsRasterLayer(mask_result['OUTPUT'])
+        return self.clipRaster('clip_final', self.INPUT, dict(parameters, MASK=parameters['DECOUPE']), context, feedback)
 
-    def generateFinalMask(self, parameters, context, feedback):
-        
-        feedback.pushInfo("......Création du mask final")    
-        mask_result = processing.run(
-            'gdal:rasterize',
-            {
-                'INPUT': parameters['DECOUPE'],
-                'BURN' : 255,
-                'NODATA': 0,
-                'EXTENT': parameters['DECOUPE'],
-                'UNITS' : 1,
-                'WIDTH' : 0.5,
-                'HEIGHT' : 0.5,
-                'DATA_TYPE' : 0,
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            },
-            is_child_algorithm=True,
-            context=context,
-            feedback=feedback)
-            
-        return QgsRasterLayer(mask_result['OUTPUT'])
-    
     def getDesaturationTuple(self,band,ref_provider,match_provider,ref_cumulhist, match_cumulhist, pourcent_desaturation,pourcent_saturation) :
         
         max_ref = len(ref_cumulhist)
@@ -239,11 +731,13 @@ class HistogramMatching(QgsProcessingAlgorithm):
         min_ref = int(max_ref-(max_ref*pourcent_desaturation/100))
         min_match = 0
         for i in match_cumulhist :
-            if (i/match_cumulhist[-1]) < (ref_cumulhist[min_ref]/ref_cumulhist[-1]) :
+            if (i/match_cumulhist[-1]) < (ref_cumulhist[min(min_ref, max_ref-1)]/ref_cumulhist[-1]) :
                 min_match+=1
             else :
                 break
         
+        if pourcent_desaturation == 0 :
+            return (min_ref, min_match, 0, 0)
         pas_match = (max_match - min_match)/pourcent_desaturation
         pas_ref = (max_ref - min_ref)/pourcent_desaturation
         
@@ -259,27 +753,273 @@ class HistogramMatching(QgsProcessingAlgorithm):
             else :
                 break
         
-        if value == min_ref :
+        if value == min_ref and pas_match != 0 :
             nbPas = (indice-min_match)/pas_match
             value = int(min_ref + nbPas*pas_ref)
         
         return value
     
-    def generateVRT(self,liste_vrt,parameters,context,feedback) :
+    def computeHistograms(self, clip_source, clip_reference, feedback, bands=(1, 2, 3)) :
+        """
+        Returns the value indexed histograms of bands for both clipped
+        rasters, 8 bits histograms having 256 values as in QGIS. Bands the
+        reference does not have get None.
+        """
+        engine = HistogramEngine(feedback=feedback)
+        histograms = []
+        for (raster, layer) in (('reference', clip_reference), ('input', clip_source)):
+            # ni l'alpha du découpage, ni celui d'une image RVBA
+            data_bands = dataBands(layer.source())
+            layer_bands = [band for band in bands if band in data_bands]
+            with self.profiler.stage('histogram', raster=raster):
+                partials = engine.compute(layer.source(), layer_bands)
+            if partials is None:
+                return None
+            length = 256 if layer.dataProvider().dataType(1) == Qgis.Byte else 0
+            vectors = dict((band, engine.valueVector(partial, length)) for (band, partial) in zip(layer_bands, partials))
+            histograms.append([vectors.get(band) for band in bands])
+        return histograms
+    
+    def computeTransformationTable(self, band, ref_histo, match_histo, pourcent_desaturation, pourcent_saturation) :
+        """
+        Returns the table of band, same values as getDesaturationTuple and
+        getRefValue applied to every value of match_histo.
+        """
+        if len(match_histo) == 0 or match_histo.sum() == 0 or ref_histo.sum() == 0 : 
+            return None
         
-        vrt_result = processing.run(
-            'gdal:buildvirtualraster',
-            {
-                'INPUT': liste_vrt,
-                'RESOLUTION': 1,
-                'SEPARATE': False,
-                'OUTPUT': parameters['OUTPUT']
-            },
-            is_child_algorithm=True,
-            context=context,
-            feedback=feedback)
+        with self.profiler.stage('lut', band=band):
+            return lutFromHistograms(ref_histo, match_histo, pourcent_desaturation, pourcent_saturation)
+    
+    def blockToArray(self, block) :
+        
+        dtype = self.BLOCK_DTYPES[block.dataType()]
+        return np.frombuffer(block.data(), dtype=dtype).reshape(block.height(), block.width())
+    
+    def readClipStrip(self, provider, extent, width, height, bands) :
+        
+        values = [self.blockToArray(provider.block(band, extent, width, height)) for band in bands]
+        alpha = self.blockToArray(provider.block(provider.bandCount(), extent, width, height))
+        self.profiler.addRead((len(bands)+1)*width*height*provider.dataTypeSize(1))
+        # l'alpha du découpage vaut le maximum du type : 255, ou 65535 en 16 bits
+        return (values, alpha > 0)
+    
+    def valueRange(self, histogram) :
+        """
+        Returns (first, count), the range of the values of a value indexed
+        histogram with a non zero count, 0 being the nodata of the clips.
+        """
+        values = np.flatnonzero(histogram[1:])+1
+        if len(values) == 0:
+            return (1, 1)
+        return (int(values[0]), int(values[-1]-values[0]+1))
+    
+    def computeLutGrid(self, clip_source, clip_reference, global_tables, ref_histograms, match_histograms, pourcent_desaturation, pourcent_saturation, cell_size, feedback, bands=(1, 2, 3)) :
+        """
+        Accumulates the histograms of every cell in a single pass over the
+        clipped rasters, by strips of rows, then computes the table of each
+        cell. Cells with too few pixels, and bands the reference does not
+        have (None in ref_histograms), keep the global tables (a LutStack).
+        The cell histograms of a band only hold the range of values found in
+        its global histogram, so that 16 bits rasters do not need cells x
+        65536 bins. As in the global histograms, the 0 nodata of the clips
+        is left out.
+        """
+        match_provider = clip_source.dataProvider()
+        ref_provider = clip_reference.dataProvider()
+        match_bins = global_tables.luts.shape[1]
+        
+        extent = clip_source.extent()
+        width = clip_source.width()
+        height = clip_source.height()
+        pixel_x = extent.width()/width
+        pixel_y = extent.height()/height
+        nx = max(1, int(math.ceil(extent.width()/cell_size)))
+        ny = max(1, int(math.ceil(extent.height()/cell_size)))
+        nb_cells = nx*ny
+        feedback.pushInfo('......Grille de '+str(nx)+' x '+str(ny)+' cellules')
+        
+        ref_bands = [band for (band, histogram) in zip(bands, ref_histograms) if histogram is not None]
+        match_ranges = [self.valueRange(histogram) for histogram in match_histograms]
+        ref_ranges = [self.valueRange(histogram) if histogram is not None else (1, 1) for histogram in ref_histograms]
+        match_hist = [np.zeros((nb_cells, count), dtype=np.int64) for (first, count) in match_ranges]
+        ref_hist = [np.zeros((nb_cells, count), dtype=np.int64) for (first, count) in ref_ranges]
+        column_cells = np.minimum(((np.arange(width)+0.5)*pixel_x/cell_size).astype(np.int64), nx-1)
+        for row in range(0, height, LutGrid.STRIP):
+            if feedback.isCanceled():
+                return None
+            rows = min(LutGrid.STRIP, height-row)
+            strip_extent = QgsRectangle(extent.xMinimum(), extent.yMaximum()-(row+rows)*pixel_y,
+                                        extent.xMaximum(), extent.yMaximum()-row*pixel_y)
+            row_cells = np.minimum(((np.arange(row, row+rows)+0.5)*pixel_y/cell_size).astype(np.int64), ny-1)
+            # seules les lignes de cellules couvertes par la bande de lignes
+            first_cell = int(row_cells[0])*nx
+            strip_cells = (int(row_cells[-1])+1)*nx-first_cell
+            cells = row_cells[:, None]*nx + column_cells[None, :] - first_cell
             
-        return QgsRasterLayer(vrt_result['OUTPUT'])
+            for (provider, hist, ranges, provider_bands) in ((match_provider, match_hist, match_ranges, bands), (ref_provider, ref_hist, ref_ranges, ref_bands)):
+                (values, valid) = self.readClipStrip(provider, strip_extent, width, rows, provider_bands)
+                for (band, value) in zip(provider_bands, values):
+                    index = list(bands).index(band)
+                    (first, count) = ranges[index]
+                    keep = valid & (value != 0)
+                    bins = cells*count + np.clip(value.astype(np.int64)-first, 0, count-1)
+                    counts = np.bincount(bins[keep], minlength=strip_cells*count)
+                    hist[index][first_cell:first_cell+strip_cells] += counts.reshape(strip_cells, count)
+        
+        global_luts = global_tables.luts
+        max_value = np.iinfo(global_luts.dtype).max
+        luts = np.empty((len(bands), nb_cells, match_bins), dtype=global_luts.dtype)
+        for band in range(len(bands)):
+            global_lut = global_luts[band]
+            if ref_histograms[band] is None:
+                luts[band] = global_lut
+                continue
+            # histogrammes de cellule replacés dans l'indexation par valeur des globaux
+            (match_first, match_count) = match_ranges[band]
+            (ref_first, ref_count) = ref_ranges[band]
+            match_cell = np.zeros(match_bins, dtype=np.int64)
+            ref_cell = np.zeros(len(ref_histograms[band]), dtype=np.int64)
+            for cell in range(nb_cells):
+                if match_hist[band][cell].sum() < self.MIN_CELL_PIXELS or ref_hist[band][cell].sum() < self.MIN_CELL_PIXELS :
+                    luts[band, cell] = global_lut
+                else :
+                    match_cell[match_first:match_first+match_count] = match_hist[band][cell]
+                    ref_cell[ref_first:ref_first+ref_count] = ref_hist[band][cell]
+                    lut = lutFromHistograms(ref_cell, match_cell, pourcent_desaturation, pourcent_saturation)
+                    luts[band, cell] = np.clip(lut, 0, max_value)
+        
+        return LutGrid(extent.xMinimum(), extent.yMaximum(), cell_size, nx, ny, luts)
+    
+    def readTile(self, final_provider, mask_provider, extent_dalle, width_dalle, height_dalle, bands=(1, 2, 3)) :
+        """
+        Reads bands over the tile as a (bands, rows, cols) array and returns
+        it with the mask of the pixels to remap : inside the raster, not
+        nodata and, with a mask, inside the mask. Tiles entirely outside the
+        mask are not read.
+        """
+        if mask_provider is not None:
+            mask = mask_provider.block(extent_dalle, width_dalle, height_dalle)
+            if not mask.any():
+                values = np.zeros((len(bands),height_dalle,width_dalle), dtype=np.uint8)
+                return (values, mask)
+        
+        blocks = [final_provider.block(band, extent_dalle, width_dalle, height_dalle) for band in bands]
+        values = np.stack([self.blockToArray(block) for block in blocks])
+        # les dalles calées sur la grille de 5 km débordent de l'image
+        valid = self.coveredPixels(final_provider.extent(), extent_dalle, width_dalle, height_dalle)
+        if blocks[0].hasNoDataValue():
+            valid &= values[0] != blocks[0].noDataValue()
+        nbytes = sum(block.width()*block.height()*block.dataTypeSize() for block in blocks)
+        
+        if mask_provider is not None:
+            valid &= mask
+        self.profiler.addRead(nbytes)
+        return (values, valid)
+    
+    def coveredPixels(self, raster_extent, extent_dalle, width_dalle, height_dalle) :
+        """
+        Returns the mask of the tile pixels inside raster_extent, with the
+        rounding of readWindow in histogramMatchingWorker.
+        """
+        covered = np.zeros((height_dalle,width_dalle), dtype=bool)
+        pixel_x = extent_dalle.width()/width_dalle
+        pixel_y = extent_dalle.height()/height_dalle
+        x0 = int(round((max(extent_dalle.xMinimum(), raster_extent.xMinimum()) - extent_dalle.xMinimum())/pixel_x))
+        x1 = int(round((min(extent_dalle.xMaximum(), raster_extent.xMaximum()) - extent_dalle.xMinimum())/pixel_x))
+        y0 = int(round((extent_dalle.yMaximum() - min(extent_dalle.yMaximum(), raster_extent.yMaximum()))/pixel_y))
+        y1 = int(round((extent_dalle.yMaximum() - max(extent_dalle.yMinimum(), raster_extent.yMinimum()))/pixel_y))
+        if x1 > x0 and y1 > y0:
+            covered[y0:y1, x0:x1] = True
+        return covered
+    
+    def remapTile(self, tile_data, transformation_tables, width_dalle, height_dalle, extent_dalle=None) :
+        
+        (values, valid) = tile_data
+        if isinstance(transformation_tables, LutGrid):
+            bands = transformation_tables.remap(values, valid, extent_dalle, width_dalle, height_dalle)
+        else :
+            bands = transformation_tables.remap(values, valid)
+        # canal alpha à la valeur maximale du type de sortie
+        alpha = np.where(valid, np.iinfo(bands.dtype).max, 0).astype(bands.dtype)
+        
+        self.profiler.addPixels(width_dalle*height_dalle)
+        return np.concatenate([bands, alpha[None]])
+    
+    def writeTile(self, path, bands, extent_dalle, source) :
+        
+        driver = gdal.GetDriverByName('GTiff')
+        ds = driver.Create(path, xsize=bands[0].shape[1], ysize=bands[0].shape[0], bands=len(bands), eType=self.GDAL_TYPES[bands.dtype.type], options=['compress=deflate','predictor=2'])
+        for (index, band) in enumerate(bands):
+            ds.GetRasterBand(index+1).WriteArray(band)
+        
+        geot = [extent_dalle.xMinimum(), source.rasterUnitsPerPixelX(), 0, extent_dalle.yMaximum(), 0, -source.rasterUnitsPerPixelY()]
+        ds.SetGeoTransform(geot)
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(int(source.crs().authid().split(':')[1]))
+        ds.SetProjection(srs.ExportToWkt())
+        ds = None
+        self.profiler.addWritten(os.path.getsize(path))
+    
+    def publishTiles(self, queue_path, parameters, context, source, mask_path, transformation_tables, tiles, width_dalle, height_dalle, bands=(1, 2, 3)) :
+        """
+        Writes the tile jobs and everything the workers need to compute them
+        (source, mask, transformation tables, tile geometry) in a SQLite file.
+        """
+        meta = {
+            'source': source.source(),
+            'mask': mask_path,
+            'tables': None,
+            'grid': None,
+            'bands': list(bands),
+            'data_type': gdal.GetDataTypeName(self.GDAL_TYPES[transformation_tables.luts.dtype.type]),
+            'width': width_dalle,
+            'height': height_dalle,
+            'pixel_x': source.rasterUnitsPerPixelX(),
+            'pixel_y': source.rasterUnitsPerPixelY(),
+            'epsg': int(source.crs().authid().split(':')[1]),
+            'output': self.parameterAsFileOutput(parameters, self.OUTPUT, context)
+        }
+        if isinstance(transformation_tables, LutGrid):
+            grid = transformation_tables
+            meta['grid'] = {'x0': grid.x0, 'y0': grid.y0, 'cell_size': grid.cell_size,
+                            'nx': grid.nx, 'ny': grid.ny, 'luts': grid.luts.tolist()}
+        else :
+            meta['tables'] = transformation_tables.luts.tolist()
+        createQueue(queue_path, meta,
+                    [(name, extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum(), path)
+                     for (name, extent, path) in tiles])
+    
+    def generateQuickLook(self, path, resolution, source, final_provider, mask_provider, transformation_tables, extent, feedback, bands=(1, 2, 3)) :
+        """
+        Writes a low resolution image of the result over extent, with pixels
+        of resolution map units (at most the input resolution), remapped with
+        the tables and the mask of the tiles. GDAL reads the input from its
+        closest overview level.
+        """
+        scale = max(resolution/max(source.rasterUnitsPerPixelX(), source.rasterUnitsPerPixelY()), 1)
+        width = max(1, int(extent.width()/source.rasterUnitsPerPixelX()/scale))
+        height = max(1, int(extent.height()/source.rasterUnitsPerPixelY()/scale))
+        if scale > 1 and not final_provider.hasPyramids() :
+            feedback.pushWarning("L'image en entrée n'a pas de pyramides : l'aperçu est lu en pleine résolution")
+        
+        tile_data = self.readTile(final_provider, mask_provider, extent, width, height, bands)
+        bands = self.remapTile(tile_data, transformation_tables, width, height, extent)
+        
+        driver = gdal.GetDriverByName('GTiff')
+        ds = driver.Create(path, xsize=width, ysize=height, bands=len(bands), eType=self.GDAL_TYPES[bands.dtype.type], options=['compress=deflate','predictor=2'])
+        for (index, band) in enumerate(bands):
+            ds.GetRasterBand(index+1).WriteArray(band)
+        ds.GetRasterBand(len(bands)).SetColorInterpretation(gdal.GCI_AlphaBand)
+        ds.SetGeoTransform([extent.xMinimum(), extent.width()/width, 0, extent.yMaximum(), 0, -extent.height()/height])
+        ds.SetProjection(source.crs().toWkt())
+        ds = None
+        feedback.pushInfo('Aperçu '+str(width)+' x '+str(height)+' écrit dans '+path)
+    
+    def generateVRT(self,vrt_builder,parameters,context,feedback) :
+        
+        vrt_builder.write()
+        return QgsRasterLayer(vrt_builder.path)
     
     def generateOverview(self,parameters,context,feedback) :
         
@@ -298,6 +1038,26 @@ class HistogramMatching(QgsProcessingAlgorithm):
     
     def processAlgorithm(self, parameters, context, feedback):
         
+        if not self.parameterAsBoolean(parameters, self.PROFILE, context):
+            try:
+                return self.runMatching(parameters, context, feedback)
+            finally:
+                self.cleanIntermediates(feedback)
+        
+        self.profiler = StageProfiler()
+        try:
+            return self.runMatching(parameters, context, feedback)
+        finally:
+            self.cleanIntermediates(feedback)
+            self.profiler.report(feedback)
+            profile_file = self.parameterAsFileOutput(parameters, self.PROFILE_FILE, context)
+            if profile_file:
+                self.profiler.writeProfile(profile_file)
+                feedback.pushInfo('Profil écrit dans '+profile_file)
+            self.profiler = NullProfiler()
+    
+    def runMatching(self, parameters, context, feedback):
+        
         source = self.parameterAsRasterLayer(
             parameters,
             self.INPUT,
@@ -328,91 +1088,93 @@ class HistogramMatching(QgsProcessingAlgorithm):
         if reference is None:
             raise QgsProcessingException(self.invalidSourceError(parameters, self.REFERENCE))
         
+        quicklook = self.parameterAsFileOutput(parameters, self.QUICKLOOK, context)
+        quicklook_only = self.parameterAsBoolean(parameters, self.QUICKLOOK_ONLY, context)
+        if quicklook_only and not quicklook:
+            raise QgsProcessingException(self.tr("Le calcul de l'aperçu seul demande un fichier d'aperçu"))
+        
+        bands = self.parameterAsInts(parameters, self.BANDS, context)
+        if not bands:
+            bands = [1, 2, 3] if source.bandCount() >= 3 else list(range(1, source.bandCount()+1))
+        output_dtype = self.OUTPUT_DTYPES[self.parameterAsEnum(parameters, self.OUTPUT_TYPE, context)]
+        
         feedback.setProgress(1)
         feedback.pushInfo('Début clip des images')
-        clip_source = self.generateClippedInput(parameters,context,feedback)
+        with self.profiler.stage('clip', raster='input'):
+            clip_source = self.generateClippedInput(parameters,context,feedback)
         
         feedback.setProgress(5)
         if feedback.isCanceled():
             return {'SUCCESS': False}
             
-        clip_reference = self.generateClippedReference(parameters,context,feedback)
+        with self.profiler.stage('clip', raster='reference'):
+            clip_reference = self.generateClippedReference(parameters,context,feedback,clip_source)
         feedback.pushInfo('Fin clip des images')
 
-        match_provider = clip_source.dataProvider()
-        ref_provider = clip_reference.dataProvider()
-        
         feedback.setProgress(10)
         if feedback.isCanceled():
             return {'SUCCESS': False}
         
-        feedback.pushInfo('Calcul Histo bande rouge')
-        ref_histo = ref_provider.histogram(1,0)
-        match_histo = match_provider.histogram(1,0)
-        
-        if len(match_histo.histogramVector) == 0 : 
-            feedback.reportError("Impossible de calculer l'histogramme",True)
+        feedback.pushInfo('Calcul des histogrammes')
+        histograms = self.computeHistograms(clip_source, clip_reference, feedback, bands)
+        if histograms is None:
             return {'SUCCESS': False}
+        (ref_histograms, match_histograms) = histograms
         
-        ref_cumulhist_red = [sum(ref_histo.histogramVector[:x+1]) for x in range(len(ref_histo.histogramVector))]
-        match_cumulhist_red = [sum(match_histo.histogramVector[:x+1]) for x in range(len(match_histo.histogramVector))]
-        
-        desaturation_red = self.getDesaturationTuple(1,ref_provider,match_provider,ref_cumulhist_red, match_cumulhist_red, pourcent_desaturation,pourcent_saturation)
-        transformation_table_red = [self.getRefValue(x,match_cumulhist_red,ref_cumulhist_red,desaturation_red) for x in range(len(match_cumulhist_red))]
-        
-        feedback.setProgress(20)
-        if feedback.isCanceled():
-            return {'SUCCESS': False}
-        
-        
-        feedback.pushInfo('Calcul Histo bande verte')
-        ref_histo = ref_provider.histogram(2,0)
-        match_histo = match_provider.histogram(2,0)
-        
-        ref_cumulhist_green = [sum(ref_histo.histogramVector[:x+1]) for x in range(len(ref_histo.histogramVector))]
-        match_cumulhist_green = [sum(match_histo.histogramVector[:x+1]) for x in range(len(match_histo.histogramVector))]
-        
-        desaturation_green = self.getDesaturationTuple(1,ref_provider,match_provider,ref_cumulhist_green, match_cumulhist_green, pourcent_desaturation,pourcent_saturation)
-        transformation_table_green = [self.getRefValue(x,match_cumulhist_green,ref_cumulhist_green,desaturation_green) for x in range(len(match_cumulhist_green))]
+        transformation_tables = []
+        for (index, band) in enumerate(bands):
+            feedback.pushInfo('Calcul table bande '+str(band))
+            if ref_histograms[index] is None :
+                # bande absente de la référence : valeurs conservées
+                feedback.pushWarning('Bande '+str(band)+' absente de la référence, non modifiée')
+                transformation_table = list(range(len(match_histograms[index])))
+            else :
+                transformation_table = self.computeTransformationTable(band, ref_histograms[index], match_histograms[index], pourcent_desaturation, pourcent_saturation)
+            if transformation_table is None :
+                feedback.reportError("Impossible de calculer l'histogramme",True)
+                return {'SUCCESS': False}
+            transformation_tables.append(transformation_table)
+            
+            feedback.setProgress(20+int((index+1)*20/len(bands)))
+            if feedback.isCanceled():
+                return {'SUCCESS': False}
+        transformation_tables = LutStack(transformation_tables, output_dtype)
 
-        feedback.setProgress(30)
-        if feedback.isCanceled():
-            return {'SUCCESS': False}
-        
-        
-        feedback.pushInfo('Calcul Histo bande bleue')
-        ref_histo = ref_provider.histogram(3,0)
-        match_histo = match_provider.histogram(3,0)
-        
-        ref_cumulhist_blue = [sum(ref_histo.histogramVector[:x+1]) for x in range(len(ref_histo.histogramVector))]
-        match_cumulhist_blue = [sum(match_histo.histogramVector[:x+1]) for x in range(len(match_histo.histogramVector))]
+        if self.parameterAsBoolean(parameters, self.LOCAL, context):
+            feedback.pushInfo('Calcul des tables locales')
+            with self.profiler.stage('local_lut'):
+                transformation_tables = self.computeLutGrid(clip_source, clip_reference, transformation_tables, ref_histograms, match_histograms,
+                                                            pourcent_desaturation, pourcent_saturation,
+                                                            self.parameterAsDouble(parameters, self.CELL_SIZE, context), feedback, bands)
+            if transformation_tables is None:
+                return {'SUCCESS': False}
         
-        desaturation_blue = self.getDesaturationTuple(1,ref_provider,match_provider,ref_cumulhist_blue, match_cumulhist_blue, pourcent_desaturation,pourcent_saturation)
-        transformation_table_blue = [self.getRefValue(x,match_cumulhist_blue,ref_cumulhist_blue,desaturation_blue) for x in range(len(match_cumulhist_blue))]
-
         feedback.setProgress(40)
-        feedback.pushInfo('Création du Raster 8 bits')
-        
-        liste_vrt=[]
-        mask_travail = self.parameterAsVectorLayer(
-            parameters,
-            self.MASK,
-            context
-        )
+        feedback.pushInfo('Création du Raster '+gdal.GetDataTypeName(self.GDAL_TYPES[output_dtype]))
         
-        mask_final = self.parameterAsVectorLayer(
+        mask_final = self.parameterAsSource(
             parameters,
             self.DECOUPE,
             context
         )
+        distributed = self.parameterAsBoolean(parameters, self.DISTRIBUTED, context) and not quicklook_only
+        output_dir = self.parameterAsFileOutput(parameters, self.OUTPUT, context).split('.')[0]
+        if not quicklook_only and not os.path.exists(output_dir):
+            os.mkdir(output_dir)
+        
         masked = True
+        mask_path = None
         if mask_final is None:
-            mask_raster = None
+            mask_provider = None
             masked = False
-        elif mask_final == mask_travail :
-            mask_raster = self.generateTravailMask(parameters,context,feedback)
         else :
-            mask_raster = self.generateFinalMask(parameters,context,feedback)
+            feedback.pushInfo("......Chargement du mask final")
+            with self.profiler.stage('mask'):
+                mask_provider = TileMaskProvider(mask_final, source.crs(), context.transformContext(), feedback)
+            if distributed:
+                # en mode distribué les polygones doivent être lisibles par les workers
+                mask_path = output_dir+'/mask.gpkg'
+                mask_provider.writeVector(mask_path, source.crs())
         
         feedback.setProgress(50)
         if feedback.isCanceled():
@@ -420,10 +1182,18 @@ class HistogramMatching(QgsProcessingAlgorithm):
 
         final_provider = source.dataProvider()
         if masked:
-            mask_provider = mask_raster.dataProvider()
             origin_extent = mask_provider.extent()
         else :
             origin_extent = final_provider.extent()
+        
+        if quicklook:
+            with self.profiler.stage('quicklook'):
+                self.generateQuickLook(quicklook, self.parameterAsDouble(parameters, self.QUICKLOOK_RESOLUTION, context),
+                                       source, final_provider, mask_provider, transformation_tables, origin_extent, feedback, bands)
+            if feedback.isCanceled():
+                return {'SUCCESS': False}
+            if quicklook_only:
+                return {'SUCCESS': True}
            
 
         if int(str(int(origin_extent.xMinimum()))[2:]) < 5000 :
@@ -457,74 +1227,57 @@ class HistogramMatching(QgsProcessingAlgorithm):
         if feedback.isCanceled():
             return {'SUCCESS': False}
             
-        if not os.path.exists(self.parameterAsFileOutput(parameters, self.OUTPUT, context).split('.')[0]):
-            os.mkdir(self.parameterAsFileOutput(parameters, self.OUTPUT, context).split('.')[0])
-            
         feedback.pushInfo('Création des dalles 8BITS')
         feedback.pushDebugInfo ('Extent finale : ('+str(fe_xmin)+','+str(fe_ymin)+','+str(fe_xmax)+','+str(fe_ymax)+')')
+        tiles = []
         for i in range(int((fe_xmax-fe_xmin)/5000)) :
             for j in range(int((fe_ymax-fe_ymin)/5000)) :
-                
-                feedback.pushInfo('..........PSUD_SAT50_'+str(fe_xmin+i*5000)+'_'+str(fe_ymin+j*5000)+'_2019_5KM')
+                name = 'PSUD_SAT50_'+str(fe_xmin+i*5000)+'_'+str(fe_ymin+j*5000)+'_2019_5KM'
                 extent_dalle = QgsRectangle(fe_xmin+i*5000,fe_ymin+j*5000,(fe_xmin+i*5000)+5000,(fe_ymin+j*5000)+5000)
-
-                band_red = np.zeros((height_dalle,width_dalle))
-                block_source_red = final_provider.block(1, extent_dalle, width_dalle, height_dalle)
-                band_green = np.zeros((height_dalle,width_dalle))
-                block_source_green = final_provider.block(2, extent_dalle, width_dalle, height_dalle)
-                band_blue = np.zeros((height_dalle,width_dalle))
-                block_source_blue = final_provider.block(3, extent_dalle, width_dalle, height_dalle)
-                band_alpha = np.zeros((height_dalle,width_dalle))
-                if masked:
-                    block_alpha =  mask_provider.block(1, extent_dalle, width_dalle, height_dalle)
-        
-                for x in range(height_dalle):
-                    for y in range(width_dalle):
-                        if (not block_source_red.isNoData(x,y)) and (masked and int(block_alpha.value(x,y)) == 255):
-                            
-                            if int(block_source_red.value(x,y)) > len(transformation_table_red)-1 :
-                                band_red[x,y] = int(transformation_table_red[-1])
-                                #feedback.pushDebugInfo ('Valeur hors limites : '+str(block_source_red.value(x,y)))
-                            else :
-                                band_red[x,y] = int(transformation_table_red[int(block_source_red.value(x,y))])
-                            
-                            if int(block_source_green.value(x,y)) > len(transformation_table_green)-1 :
-                                band_green[x,y]=int(transformation_table_green[-1])
-                                #feedback.pushDebugInfo ('Valeur hors limites : '+str(block_source_green.value(x,y)))
-                            else :
-                                band_green[x,y]=int(transformation_table_green[int(block_source_green.value(x,y))])
-                            
-                            if int(block_source_blue.value(x,y)) > len(transformation_table_blue)-1 :
-                                band_blue[x,y]=int(transformation_table_blue[-1])
-                                #feedback.pushDebugInfo ('Valeur hors limites : '+str(block_source_blue.value(x,y)))
-                            else :
-                                band_blue[x,y]=int(transformation_table_blue[int(block_source_blue.value(x,y))])
-                            
-                            band_alpha[x,y]=255
-                
-                driver = gdal.GetDriverByName('GTiff')
-                ds = driver.Create(self.parameterAsFileOutput(parameters, self.OUTPUT, context).split('.')[0]+'/PSUD_SAT50_'+str(fe_xmin+i*5000)+'_'+str(fe_ymin+j*5000)+'_2019_5KM.tif', xsize=width_dalle, ysize=height_dalle, bands=4, eType=gdal.GDT_Byte, options=['compress=deflate','predictor=2'])
-                ds.GetRasterBand(1).WriteArray(band_red)
-                ds.GetRasterBand(2).WriteArray(band_green)
-                ds.GetRasterBand(3).WriteArray(band_blue)
-                ds.GetRasterBand(4).WriteArray(band_alpha)
-                
-                geot = [extent_dalle.xMinimum(), source.rasterUnitsPerPixelX(), 0, extent_dalle.yMaximum(), 0, -source.rasterUnitsPerPixelY()]
-                ds.SetGeoTransform(geot)
-                srs = osr.SpatialReference()
-                srs.ImportFromEPSG(int(source.crs().authid().split(':')[1]))
-                ds.SetProjection(srs.ExportToWkt())
-                ds = None
-                
-                liste_vrt.append(self.parameterAsFileOutput(parameters, self.OUTPUT, context).split('.')[0]  + '/PSUD_SAT50_'+str(fe_xmin+i*5000)+'_'+str(fe_ymin+j*5000)+'_2019_5KM.tif')
-                
-                avance = int((i*((fe_ymax-fe_ymin)/5000)+j)*40/(((fe_xmax-fe_xmin)/5000)*((fe_ymax-fe_ymin)/5000)))
-                feedback.setProgress(60+avance)
-                if feedback.isCanceled():
-                    return {'SUCCESS': False}
-        
-        vrt_raster = self.generateVRT(liste_vrt,parameters,context,feedback)
-        self.generateOverview(parameters,context,feedback)
+                tiles.append((name, extent_dalle, output_dir+'/'+name+'.tif'))
+        vrt_builder = VrtBuilder(self.parameterAsFileOutput(parameters, self.OUTPUT, context), source.crs().toWkt(),
+                                 source.rasterUnitsPerPixelX(), source.rasterUnitsPerPixelY(),
+                                 len(bands)+1, gdal.GetDataTypeName(self.GDAL_TYPES[output_dtype]),
+                                 colorInterpretations(source.source(), bands))
+        
+        if distributed:
+            queue_path = output_dir+'.sqlite'
+            self.publishTiles(queue_path, parameters, context, source, mask_path,
+                              transformation_tables, tiles, width_dalle, height_dalle, bands)
+            feedback.pushInfo(str(len(tiles))+' dalles publiées dans '+queue_path)
+            feedback.pushInfo('Lancer un ou plusieurs workers : python histogramMatchingWorker.py "'+queue_path+'"')
+            return {'SUCCESS': True}
+        
+        def read(tile):
+            (name, extent_dalle, path) = tile
+            with self.profiler.stage('read', tile=name):
+                return self.readTile(final_provider, mask_provider, extent_dalle, width_dalle, height_dalle, bands)
+        
+        def remap(tile, data):
+            with self.profiler.stage('remap', tile=tile[0]):
+                return self.remapTile(data, transformation_tables, width_dalle, height_dalle, tile[1])
+        
+        def write(tile, bands):
+            (name, extent_dalle, path) = tile
+            with self.profiler.stage('write', tile=name):
+                self.writeTile(path, bands, extent_dalle, source)
+        
+        written = [0]
+        def on_written(tile):
+            (name, extent_dalle, path) = tile
+            vrt_builder.addTile(path, extent_dalle.xMinimum(), extent_dalle.yMaximum(), width_dalle, height_dalle)
+            written[0] += 1
+            feedback.pushInfo('..........'+tile[0])
+            feedback.setProgress(60+int(written[0]*40/len(tiles)))
+        
+        pipeline = TilePipeline(read, remap, write, self.PIPELINE_DEPTH, feedback)
+        if not pipeline.run(tiles, on_written):
+            return {'SUCCESS': False}
+        
+        with self.profiler.stage('vrt'):
+            vrt_raster = self.generateVRT(vrt_builder,parameters,context,feedback)
+        with self.profiler.stage('overviews'):
+            self.generateOverview(parameters,context,feedback)
         
         return {'SUCCESS': True}
 
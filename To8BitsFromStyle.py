@@ -14,19 +14,39 @@
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (QgsProcessing,
                        QgsFeatureSink,
+                       QgsRasterFileWriter,
                        QgsProcessingException,
                        QgsProcessingAlgorithm,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingParameterBoolean,
                        QgsProcessingParameterRasterLayer,
                        QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterRasterDestination)
 from qgis import processing
+from osgeo import gdal
+import numpy as np
+import os
+import sys
 
+# les modules partagés sont à côté des scripts, dossier que QGIS n'ajoute pas à sys.path
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+if SCRIPT_DIR not in sys.path:
+    sys.path.insert(0, SCRIPT_DIR)
+from rasterTools import HistogramEngine, IntermediateStorage, QuantileSketch
 
-class To8BitsFromStyle(QgsProcessingAlgorithm):
+
+class To8BitsFromStyle(IntermediateStorage, QgsProcessingAlgorithm):
 
     INPUT = 'INPUT'
     OUTPUT = 'OUTPUT'
     MASK = 'MASK'
+    AUTO_STRETCH = 'AUTO_STRETCH'
+    PERCENT_LOW = 'PERCENT_LOW'
+    PERCENT_HIGH = 'PERCENT_HIGH'
+    
+    def __init__(self):
+        super().__init__()
+        self.intermediates = []
 
     def tr(self, string):
         return QCoreApplication.translate('Processing', string)
@@ -66,6 +86,36 @@ class To8BitsFromStyle(QgsProcessingAlgorithm):
             )
         )
         
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.AUTO_STRETCH,
+                self.tr('Étirement automatique par percentiles (ignore le style)'),
+                defaultValue=False
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.PERCENT_LOW,
+                self.tr('Percentile bas (%)'),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0,
+                maxValue=100,
+                defaultValue=2
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.PERCENT_HIGH,
+                self.tr('Percentile haut (%)'),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0,
+                maxValue=100,
+                defaultValue=98
+            )
+        )
+        
         self.addParameter(
             QgsProcessingParameterRasterDestination(
                 self.OUTPUT,
@@ -73,8 +123,38 @@ class To8BitsFromStyle(QgsProcessingAlgorithm):
             )
         )
 
+    def computePercentileStretch(self, path, data_type, percent_low, percent_high, feedback):
+        """
+        Returns the (min, max) cut-off values of the bands 1 to 3 of path in
+        a single streaming pass: exact histograms for integer rasters, a
+        quantile sketch for float rasters. Masked pixels are ignored.
+        """
+        sketch = QuantileSketch() if data_type in (gdal.GDT_Float32, gdal.GDT_Float64) else None
+        histograms = HistogramEngine(feedback=feedback).compute(path, (1, 2, 3), sketch)
+        if histograms is None:
+            return None
+        
+        stretch = []
+        for (first, counts) in histograms:
+            if counts.sum() == 0:
+                raise QgsProcessingException(self.tr('Aucun pixel valide pour calculer les percentiles'))
+            cumulhist = np.cumsum(counts)
+            bounds = []
+            for percent in (percent_low, percent_high):
+                key = first + int(np.searchsorted(cumulhist, cumulhist[-1]*percent/100))
+                bounds.append(key if sketch is None else sketch.value(key))
+            stretch.append(tuple(bounds))
+        return stretch
+    
     def processAlgorithm(self, parameters, context, feedback):
         
+        try:
+            return self.convertTo8Bits(parameters, context, feedback)
+        finally:
+            self.cleanIntermediates(feedback)
+    
+    def convertTo8Bits(self, parameters, context, feedback):
+        
         apply_mask = True
         
         source = self.parameterAsRasterLayer(
@@ -94,40 +174,46 @@ class To8BitsFromStyle(QgsProcessingAlgorithm):
         if mask is None:
             apply_mask = False
         
-        min_red = source.renderer().redContrastEnhancement().minimumValue()
-        max_red = source.renderer().redContrastEnhancement().maximumValue()
-        min_green = source.renderer().greenContrastEnhancement().minimumValue()
-        max_green = source.renderer().greenContrastEnhancement().maximumValue()
-        min_blue = source.renderer().blueContrastEnhancement().minimumValue()
-        max_blue = source.renderer().blueContrastEnhancement().maximumValue()
+        auto_stretch = self.parameterAsBoolean(parameters, self.AUTO_STRETCH, context)
+        if not auto_stretch :
+            if not hasattr(source.renderer(), 'redContrastEnhancement') :
+                raise QgsProcessingException(self.tr("La couche n'a pas de style RVB : utiliser l'étirement automatique"))
+            min_red = source.renderer().redContrastEnhancement().minimumValue()
+            max_red = source.renderer().redContrastEnhancement().maximumValue()
+            min_green = source.renderer().greenContrastEnhancement().minimumValue()
+            max_green = source.renderer().greenContrastEnhancement().maximumValue()
+            min_blue = source.renderer().blueContrastEnhancement().minimumValue()
+            max_blue = source.renderer().blueContrastEnhancement().maximumValue()
         
-        input = parameters['INPUT']
+        input = source.source()
         if apply_mask :
-            clip_result = processing.run(
-            'gdal:cliprasterbymasklayer',
-            {
-                'INPUT': parameters['INPUT'],
-                'MASK' : parameters['MASK'],
-                'ALPHA_BAND' : True,
-                'NODATA' : 0,
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            },
-            is_child_algorithm=True,
-            context=context,
-            feedback=feedback)
-            input = clip_result['OUTPUT']
+            input = self.clipRaster('clip_input', self.INPUT, parameters, context, feedback).source()
+            if feedback.isCanceled():
+                return {}
+        
+        if auto_stretch :
+            # percentiles calculés sur l'image découpée, donc dans le masque
+            feedback.pushInfo('Calcul des percentiles')
+            ds = gdal.Open(input, gdal.GA_ReadOnly)
+            data_type = ds.GetRasterBand(1).DataType
+            ds = None
+            stretch = self.computePercentileStretch(
+                input, data_type,
+                self.parameterAsDouble(parameters, self.PERCENT_LOW, context),
+                self.parameterAsDouble(parameters, self.PERCENT_HIGH, context), feedback)
+            if stretch is None:
+                return {}
+            ((min_red, max_red), (min_green, max_green), (min_blue, max_blue)) = stretch
+            feedback.pushInfo('Étirement : '+str(stretch))
         
         extra_param = '-b 1 -b 2 -b 3 -b 4 -a_nodata none -scale_1 '+str(min_red)+' '+str(max_red)+' -scale_2 '+str(min_green)+' '+str(max_green)+' -scale_3 '+str(min_blue)+' '+str(max_blue)+' -scale_4 0 1 -colorinterp_4 alpha'
-        translate_result = processing.run(
-            'gdal:translate',
-            {
-                'INPUT': input,
-                'EXTRA': extra_param,
-                'DATA_TYPE': 1,
-                'OUTPUT': parameters['OUTPUT']
-            },
-            is_child_algorithm=True,
-            context=context,
-            feedback=feedback)
-        
-        return {'OUTPUT': translate_result['OUTPUT']}
+        # le découpage peut être en /vsimem/ : la conversion est faite dans le processus QGIS
+        output = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
+        driver = QgsRasterFileWriter.driverForExtension(os.path.splitext(output)[1]) or 'GTiff'
+        ds = gdal.Translate(output, input, options=extra_param, format=driver, outputType=gdal.GDT_Byte,
+                            callback=self.gdalCallback(feedback))
+        if ds is None and not feedback.isCanceled():
+            raise QgsProcessingException(self.tr('Échec de la conversion en 8 bits'))
+        ds = None
+        
+        return {'OUTPUT': output}
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Benchmark des algorithmes raster sur des données synthétiques.
+
+Génère des GeoTIFF et des polygones de masque de plusieurs tailles,
+profondeurs et nombres de dalles, chronomètre chaque étape des algorithmes
+sans interface graphique et enregistre les résultats en JSON. Un run peut
+être comparé à une référence enregistrée :
+
+    python benchmarks/run_benchmarks.py --output resultats.json
+    python benchmarks/run_benchmarks.py --baseline resultats.json
+
+Le code de retour vaut 1 si une étape a régressé au delà de la tolérance.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from osgeo import gdal, ogr, osr
+import numpy as np
+
+from qgis.core import (Qgis,
+                       QgsApplication,
+                       QgsProject,
+                       QgsRasterLayer,
+                       QgsRectangle,
+                       QgsProcessingContext,
+                       QgsProcessingFeedback)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# origine alignée sur la grille de 10 km attendue par le découpage en dalles
+ORIGIN_X = 400000
+ORIGIN_Y = 200000
+EPSG = 3163
+DALLE = 5000
+
+
+def initQgis():
+    QgsApplication.setPrefixPath(os.environ.get('QGIS_PREFIX_PATH', '/usr'), True)
+    qgs = QgsApplication([], False)
+    qgs.initQgis()
+    sys.path.append(os.path.join(QgsApplication.prefixPath(), 'share', 'qgis', 'python', 'plugins'))
+    from processing.core.Processing import Processing
+    Processing.initialize()
+    return qgs
+
+
+def generateRaster(path, size, depth, tiles, seed):
+    """
+    Writes a 3 band GeoTIFF of size x size pixels covering tiles x tiles dalles,
+    with a smooth gradient plus noise so that the histograms are realistic.
+    """
+    rng = np.random.default_rng(seed)
+    data_type = gdal.GDT_Byte if depth == 8 else gdal.GDT_UInt16
+    max_value = 2 ** depth - 1
+    pixel_size = DALLE * tiles / float(size)
+
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(path, size, size, 3, data_type, options=['tiled=yes', 'compress=deflate'])
+    ds.SetGeoTransform([ORIGIN_X, pixel_size, 0, ORIGIN_Y + size * pixel_size, 0, -pixel_size])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    ds.SetProjection(srs.ExportToWkt())
+
+    rows = 512
+    gradient = np.linspace(0.2, 0.8, size)
+    for band in range(1, 4):
+        raster_band = ds.GetRasterBand(band)
+        for row in range(0, size, rows):
+            height = min(rows, size - row)
+            ramp = gradient[row:row + height, None] * gradient[None, :] * (0.8 + 0.1 * band)
+            noise = rng.normal(0, 0.05, (height, size))
+            values = np.clip((ramp + noise) * max_value, 1, max_value)
+            raster_band.WriteArray(values.astype(np.uint8 if depth == 8 else np.uint16), 0, row)
+    ds = None
+
+
+def generateMask(path, tiles):
+    """
+    Writes a polygon covering the center of the raster, leaving a margin so
+    that the clip and the mask both have work to do.
+    """
+    width = DALLE * tiles
+    margin = width * 0.05
+    driver = ogr.GetDriverByName('GPKG')
+    ds = driver.CreateDataSource(path)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    layer = ds.CreateLayer('mask', srs, ogr.wkbPolygon)
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for (x, y) in ((margin, margin), (width - margin, 2 * margin), (width - margin, width - margin),
+                   (2 * margin, width - margin), (margin, margin)):
+        ring.AddPoint_2D(ORIGIN_X + x, ORIGIN_Y + y)
+    polygon = ogr.Geometry(ogr.wkbPolygon)
+    polygon.AddGeometry(ring)
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(polygon)
+    layer.CreateFeature(feature)
+    ds = None
+
+
+class Timer:
+    """
+    Accumulates the duration of named stages.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+
+class _Stage:
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.timer.stages[self.name] = self.timer.stages.get(self.name, 0) + time.perf_counter() - self.start
+
+
+def benchmarkHistogramMatching(workdir, input_path, reference_path, mask_path, timer):
+    from HistogramMatching import HistogramMatching, LutStack, TileMaskProvider, VrtBuilder
+
+    algorithm = HistogramMatching()
+    algorithm.initAlgorithm()
+    context = QgsProcessingContext()
+    context.setProject(QgsProject.instance())
+    feedback = QgsProcessingFeedback()
+    output = os.path.join(workdir, 'matching.vrt')
+    parameters = {'INPUT': input_path, 'REFERENCE': reference_path, 'MASK': mask_path,
+                  'DECOUPE': mask_path, 'OUTPUT': output}
+
+    with timer.stage('clip'):
+        clip_source = algorithm.generateClippedInput(parameters, context, feedback)
+        clip_reference = algorithm.generateClippedReference(parameters, context, feedback, clip_source)
+
+    with timer.stage('histogram'):
+        (ref_histograms, match_histograms) = algorithm.computeHistograms(clip_source, clip_reference, feedback)
+
+    with timer.stage('lut'):
+        transformation_tables = LutStack([algorithm.computeTransformationTable(band, ref_histograms[band-1], match_histograms[band-1], 1, 0)
+                                          for band in (1, 2, 3)])
+
+    source = QgsRasterLayer(input_path)
+    with timer.stage('mask'):
+        mask_provider = TileMaskProvider(algorithm.parameterAsSource(parameters, 'DECOUPE', context),
+                                         source.crs(), context.transformContext(), feedback)
+    final_provider = source.dataProvider()
+    extent = final_provider.extent()
+    width_dalle = int(DALLE / float(source.rasterUnitsPerPixelX()))
+    height_dalle = int(DALLE / float(source.rasterUnitsPerPixelY()))
+    tiles_dir = os.path.join(workdir, 'matching')
+    os.mkdir(tiles_dir)
+    vrt_builder = VrtBuilder(output, source.crs().toWkt(), source.rasterUnitsPerPixelX(), source.rasterUnitsPerPixelY())
+    x = extent.xMinimum()
+    while x < extent.xMaximum():
+        y = extent.yMinimum()
+        while y < extent.yMaximum():
+            extent_dalle = QgsRectangle(x, y, x + DALLE, y + DALLE)
+            with timer.stage('read'):
+                blocks = algorithm.readTile(final_provider, mask_provider, extent_dalle, width_dalle, height_dalle)
+            with timer.stage('remap'):
+                bands = algorithm.remapTile(blocks, transformation_tables, width_dalle, height_dalle)
+            path = os.path.join(tiles_dir, '%d_%d.tif' % (x, y))
+            with timer.stage('write'):
+                algorithm.writeTile(path, bands, extent_dalle, source)
+            vrt_builder.addTile(path, x, y + DALLE, width_dalle, height_dalle)
+            y += DALLE
+        x += DALLE
+
+    with timer.stage('vrt'):
+        algorithm.generateVRT(vrt_builder, parameters, context, feedback)
+    with timer.stage('overviews'):
+        algorithm.generateOverview(parameters, context, feedback)
+    algorithm.cleanIntermediates(feedback)
+
+
+def benchmarkEgalisation(workdir, input_path, reference_path, mask_path, timer):
+    from EgalisationColorimetrique import EgalisationColorimetrique
+
+    algorithm = EgalisationColorimetrique()
+    algorithm.initAlgorithm()
+    context = QgsProcessingContext()
+    context.setProject(QgsProject.instance())
+    feedback = QgsProcessingFeedback()
+    parameters = {'INPUT': input_path, 'REFERENCE': reference_path, 'MASK': mask_path}
+
+    with timer.stage('egalisation'):
+        algorithm.computeFullStretch(parameters, context, feedback)
+    algorithm.cleanIntermediates(feedback)
+
+
+def benchmarkTo8Bits(workdir, input_path, mask_path, timer):
+    from To8BitsFromStyle import To8BitsFromStyle
+
+    algorithm = To8BitsFromStyle()
+    algorithm.initAlgorithm()
+    context = QgsProcessingContext()
+    context.setProject(QgsProject.instance())
+    feedback = QgsProcessingFeedback()
+    parameters = {'INPUT': input_path, 'MASK': mask_path, 'OUTPUT': os.path.join(workdir, 'to8bits.tif')}
+
+    with timer.stage('to8bits'):
+        algorithm.processAlgorithm(parameters, context, feedback)
+
+
+def runCase(size, depth, tiles, repeat):
+    """
+    Runs every benchmark on one synthetic dataset and keeps, for each stage,
+    the best time over the repetitions.
+    """
+    best = {}
+    for run in range(repeat):
+        workdir = tempfile.mkdtemp(prefix='geoscript_bench_')
+        try:
+            input_path = os.path.join(workdir, 'input.tif')
+            reference_path = os.path.join(workdir, 'reference.tif')
+            mask_path = os.path.join(workdir, 'mask.gpkg')
+            generateRaster(input_path, size, depth, tiles, seed=1)
+            generateRaster(reference_path, size, 8, tiles, seed=2)
+            generateMask(mask_path, tiles)
+
+            timer = Timer()
+            benchmarkHistogramMatching(workdir, input_path, reference_path, mask_path, timer)
+            benchmarkEgalisation(workdir, input_path, reference_path, mask_path, timer)
+            benchmarkTo8Bits(workdir, input_path, mask_path, timer)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        for (stage, duration) in timer.stages.items():
+            best[stage] = min(duration, best.get(stage, duration))
+    return best
+
+
+def compare(results, baseline, tolerance, min_delta):
+    """
+    Prints the ratio of every stage against the baseline and returns the
+    list of (case, stage, ratio) regressions.
+    """
+    regressions = []
+    for (case, stages) in sorted(results['results'].items()):
+        reference = baseline['results'].get(case)
+        if reference is None:
+            print('%-28s absent de la référence' % case)
+            continue
+        for (stage, duration) in sorted(stages.items()):
+            if stage not in reference:
+                continue
+            ratio = duration / reference[stage] if reference[stage] > 0 else float('inf')
+            flag = ''
+            if ratio > 1 + tolerance and duration - reference[stage] > min_delta:
+                flag = '  REGRESSION'
+                regressions.append((case, stage, ratio))
+            print('%-28s %-10s %9.3fs %9.3fs  x%.2f%s' % (case, stage, reference[stage], duration, ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark des algorithmes raster sur données synthétiques')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 4000], help='taille des rasters en pixels')
+    parser.add_argument('--depths', type=int, nargs='+', default=[8, 16], choices=[8, 16], help='profondeur en bits')
+    parser.add_argument('--tiles', type=int, nargs='+', default=[1, 2], help='nombre de dalles de 5 km par côté')
+    parser.add_argument('--repeat', type=int, default=1, help='nombre de répétitions, le meilleur temps est conservé')
+    parser.add_argument('--output', help='fichier JSON des résultats')
+    parser.add_argument('--baseline', help='fichier JSON de référence à comparer')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='ralentissement relatif toléré')
+    parser.add_argument('--min-delta', type=float, default=0.05, help='écart absolu minimal en secondes pour signaler une régression')
+    args = parser.parse_args(argv)
+
+    qgs = initQgis()
+    results = {
+        'qgis': Qgis.QGIS_VERSION,
+        'gdal': gdal.__version__,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': {}
+    }
+    for size in args.sizes:
+        for depth in args.depths:
+            for tiles in args.tiles:
+                case = 'size%d_%dbits_%dx%dtiles' % (size, depth, tiles, tiles)
+                print('Benchmark ' + case)
+                results['results'][case] = runCase(size, depth, tiles, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.min_delta)
+    else:
+        for (case, stages) in sorted(results['results'].items()):
+            for (stage, duration) in sorted(stages.items()):
+                print('%-28s %-10s %9.3fs' % (case, stage, duration))
+
+    qgs.exitQgis()
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Worker de l'exécution distribuée de 'Histogram Matching'.
+
+L'algorithme QGIS, avec l'option de file de travail, calcule les tables de
+transformation et la liste des dalles puis les publie dans une base SQLite
+placée à côté du VRT final. Autant de workers que voulu, sur la même machine
+ou sur d'autres machines voyant les mêmes chemins, réservent ensuite les
+dalles avec un bail, les calculent et les écrivent :
+
+    python histogramMatchingWorker.py /chemin/sortie.sqlite
+
+Le dernier worker à terminer construit le VRT et ses pyramides. Seuls GDAL,
+numpy et le module tileQueue.py placé à côté du worker sont nécessaires,
+QGIS n'est pas requis.
+"""
+
+import argparse
+import math
+import os
+import socket
+import sys
+import time
+
+try:
+    from osgeo import gdal, ogr, osr
+except ImportError:
+    import gdal, ogr, osr
+
+import numpy as np
+
+from tileQueue import (connect, readMeta, claimTile, completeTile, releaseTile,
+                       countTiles, startFinalize, endFinalize)
+
+
+def readWindow(ds, bands, xmin, ymin, xmax, ymax, width, height):
+    """
+    Reads the bands of ds over the extent, resampled to width x height with
+    a nearest neighbour, like QgsRasterDataProvider.block. Pixels outside the
+    raster are set to 0 and flagged in the returned coverage mask.
+    """
+    gt = ds.GetGeoTransform()
+    px0 = (xmin - gt[0]) / gt[1]
+    px1 = (xmax - gt[0]) / gt[1]
+    py0 = (ymax - gt[3]) / gt[5]
+    py1 = (ymin - gt[3]) / gt[5]
+    step_x = (px1 - px0) / width
+    step_y = (py1 - py0) / height
+
+    data_type = ds.GetRasterBand(bands[0]).DataType
+    values = np.zeros((len(bands), height, width), dtype=np.uint8 if data_type == gdal.GDT_Byte else np.float64)
+    covered = np.zeros((height, width), dtype=bool)
+
+    cx0 = max(px0, 0)
+    cx1 = min(px1, ds.RasterXSize)
+    cy0 = max(py0, 0)
+    cy1 = min(py1, ds.RasterYSize)
+    if cx1 <= cx0 or cy1 <= cy0:
+        return (values, covered)
+
+    dx0 = int(round((cx0 - px0) / step_x))
+    dx1 = int(round((cx1 - px0) / step_x))
+    dy0 = int(round((cy0 - py0) / step_y))
+    dy1 = int(round((cy1 - py0) / step_y))
+    if dx1 <= dx0 or dy1 <= dy0:
+        return (values, covered)
+
+    xoff = int(math.floor(cx0))
+    yoff = int(math.floor(cy0))
+    xsize = int(math.ceil(cx1)) - xoff
+    ysize = int(math.ceil(cy1)) - yoff
+    for (index, band) in enumerate(bands):
+        values[index, dy0:dy1, dx0:dx1] = ds.GetRasterBand(band).ReadAsArray(
+            xoff, yoff, xsize, ysize, buf_xsize=dx1 - dx0, buf_ysize=dy1 - dy0)
+    covered[dy0:dy1, dx0:dx1] = True
+    return (values, covered)
+
+
+def maskTile(mask_layer, xmin, ymin, xmax, ymax, width, height):
+    """
+    Same as HistogramMatching.TileMaskProvider.block : the polygons
+    intersecting the tile are rasterized at the tile resolution, tiles fully
+    inside or outside the mask are answered without rasterization.
+    """
+    tile = ogr.CreateGeometryFromWkt('POLYGON ((%r %r, %r %r, %r %r, %r %r, %r %r))' % (
+        xmin, ymin, xmax, ymin, xmax, ymax, xmin, ymax, xmin, ymin))
+    mask_layer.SetSpatialFilterRect(xmin, ymin, xmax, ymax)
+    geometries = []
+    for feature in mask_layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        if geometry.Contains(tile):
+            return np.ones((height, width), dtype=bool)
+        if geometry.Intersects(tile):
+            geometries.append(geometry.Clone())
+    if not geometries:
+        return np.zeros((height, width), dtype=bool)
+
+    ds = gdal.GetDriverByName('MEM').Create('', width, height, 1, gdal.GDT_Byte)
+    ds.SetGeoTransform([xmin, (xmax - xmin) / width, 0, ymax, 0, -(ymax - ymin) / height])
+    layer = ogr.GetDriverByName('Memory').CreateDataSource('').CreateLayer('mask', None, ogr.wkbUnknown)
+    for geometry in geometries:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(geometry)
+        layer.CreateFeature(feature)
+    gdal.RasterizeLayer(ds, [1], layer, burn_values=[255])
+    return ds.GetRasterBand(1).ReadAsArray() == 255
+
+
+def gridAxis(centers, cell_size, count):
+    position = centers / cell_size - 0.5
+    index0 = np.clip(np.floor(position), 0, count - 1).astype(np.intp)
+    index1 = np.minimum(index0 + 1, count - 1)
+    weight = np.clip(position - index0, 0, 1).astype(np.float32)
+    return (index0, index1, weight)
+
+
+def remapGrid(grid, values, xmin, ymax, pixel_x, pixel_y, width, height, strip=512):
+    """
+    Same as HistogramMatching.LutGrid.remap : bilinear blend of the tables
+    of the four cells surrounding each pixel.
+    """
+    nx = grid['nx']
+    (ix0, ix1, wx) = gridAxis(xmin - grid['x0'] + (np.arange(width) + 0.5) * pixel_x, grid['cell_size'], nx)
+    (iy0, iy1, wy) = gridAxis(grid['y0'] - ymax + (np.arange(height) + 0.5) * pixel_y, grid['cell_size'], grid['ny'])
+    bins = grid['luts'].shape[2]
+    luts = grid['luts'].reshape(grid['luts'].shape[0], -1)
+
+    bands = np.zeros((len(values), height, width), dtype=luts.dtype)
+    for row in range(0, height, strip):
+        rows = slice(row, min(row + strip, height))
+        top = (iy0[rows] * nx)[:, None]
+        bottom = (iy1[rows] * nx)[:, None]
+        corners = ((top + ix0[None, :]) * bins, (top + ix1[None, :]) * bins,
+                   (bottom + ix0[None, :]) * bins, (bottom + ix1[None, :]) * bins)
+        ry = wy[rows][:, None]
+        for (band, value, lut) in zip(bands, values, luts):
+            value = np.clip(value[rows].astype(np.intp), 0, bins - 1)
+            (c00, c10, c01, c11) = (lut[corner + value] for corner in corners)
+            blend = (1 - ry) * ((1 - wx) * c00 + wx * c10) + ry * ((1 - wx) * c01 + wx * c11)
+            band[rows] = np.rint(blend).astype(luts.dtype)
+    return bands
+
+
+def remapTile(source_ds, mask_layer, tables, grid, tile, width, height, source_bands):
+    """
+    Same computation as HistogramMatching.readTile/remapTile, with GDAL
+    reads instead of the QGIS provider. tables is the (bands, bins) array
+    of HistogramMatching.LutStack.
+    """
+    (tile_id, name, xmin, ymin, xmax, ymax, path) = tile
+    if mask_layer is not None:
+        mask = maskTile(mask_layer, xmin, ymin, xmax, ymax, width, height)
+        if not mask.any():
+            values = np.zeros((len(source_bands), height, width), dtype=np.uint8)
+            valid = mask
+        else:
+            (values, valid) = readWindow(source_ds, source_bands, xmin, ymin, xmax, ymax, width, height)
+            valid &= mask
+    else:
+        (values, valid) = readWindow(source_ds, source_bands, xmin, ymin, xmax, ymax, width, height)
+    nodata = source_ds.GetRasterBand(source_bands[0]).GetNoDataValue()
+    if nodata is not None:
+        valid &= values[0] != nodata
+
+    if grid is not None:
+        bands = remapGrid(grid, values, xmin, ymax, (xmax - xmin) / width, (ymax - ymin) / height, width, height)
+    else:
+        bins = tables.shape[1]
+        index = np.clip(values.astype(np.intp), 0, bins - 1)
+        index += (np.arange(len(tables)) * bins)[:, None, None]
+        bands = np.take(tables, index)
+    bands[:, ~valid] = 0
+    alpha = np.where(valid, np.iinfo(bands.dtype).max, 0).astype(bands.dtype)
+    return np.concatenate([bands, alpha[None]])
+
+
+def writeTile(path, bands, xmin, ymax, pixel_x, pixel_y, epsg, data_type=gdal.GDT_Byte):
+    # écriture dans un fichier temporaire puis renommage : une dalle reprise
+    # après expiration d'un bail n'est jamais lue à moitié écrite
+    tmp_path = path + '.' + socket.gethostname() + '_' + str(os.getpid()) + '.tmp'
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(tmp_path, xsize=bands[0].shape[1], ysize=bands[0].shape[0], bands=len(bands), eType=data_type, options=['compress=deflate', 'predictor=2'])
+    for (index, band) in enumerate(bands):
+        ds.GetRasterBand(index + 1).WriteArray(band)
+    ds.SetGeoTransform([xmin, pixel_x, 0, ymax, 0, -pixel_y])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    ds.SetProjection(srs.ExportToWkt())
+    ds = None
+    os.replace(tmp_path, path)
+
+
+def finalize(conn, meta):
+    """
+    Builds the VRT and its overviews once every tile is done. Only the
+    worker that switches the state from pending to running does it.
+    """
+    if not startFinalize(conn):
+        return False
+
+    paths = [row[0] for row in conn.execute('SELECT path FROM tiles ORDER BY id')]
+    vrt = gdal.BuildVRT(meta['output'], paths, resolution='highest')
+    vrt = None
+    ds = gdal.Open(meta['output'], gdal.GA_ReadOnly)
+    ds.BuildOverviews('AVERAGE', [2, 4, 8, 16, 32, 64, 128])
+    ds = None
+    endFinalize(conn)
+    return True
+
+
+def work(queue_path, lease=600, max_attempts=3, poll=5, wait=False):
+    """
+    Processes tiles until none is left, then tries to finalize. With wait,
+    the worker keeps polling while other workers still hold tiles, so that
+    it can take over an expired lease.
+    """
+    conn = connect(queue_path)
+    meta = readMeta(conn)
+    worker = socket.gethostname() + ':' + str(os.getpid())
+    # files publiées avant le choix des bandes : RVB 8 bits
+    source_bands = meta.get('bands', [1, 2, 3])
+    data_type = gdal.GetDataTypeByName(meta.get('data_type', 'Byte'))
+    dtype = np.uint16 if data_type == gdal.GDT_UInt16 else np.uint8
+    tables = None
+    grid = meta.get('grid')
+    if grid is not None:
+        grid['luts'] = np.asarray(grid['luts'], dtype=dtype)
+    else:
+        tables = np.asarray(meta['tables'], dtype=dtype)
+
+    source_ds = gdal.Open(meta['source'])
+    mask_ds = ogr.Open(meta['mask']) if meta['mask'] else None
+    mask_layer = mask_ds.GetLayer(0) if mask_ds is not None else None
+    if source_ds is None:
+        raise RuntimeError('Impossible d\'ouvrir ' + meta['source'])
+
+    done = 0
+    while True:
+        tile = claimTile(conn, worker, lease, max_attempts)
+        if tile is None:
+            counts = countTiles(conn)
+            if wait and counts.get('running', 0):
+                time.sleep(poll)
+                continue
+            break
+        try:
+            bands = remapTile(source_ds, mask_layer, tables, grid, tile, meta['width'], meta['height'], source_bands)
+            writeTile(tile[6], bands, tile[2], tile[5], meta['pixel_x'], meta['pixel_y'], meta['epsg'], data_type)
+        except Exception as e:
+            releaseTile(conn, tile[0], worker, max_attempts, str(e))
+            print(worker + ' : échec ' + tile[1] + ' : ' + str(e), file=sys.stderr)
+            continue
+        if not completeTile(conn, tile[0], worker):
+            # bail expiré pendant le calcul : la dalle appartient à un autre worker
+            print(worker + ' : bail perdu ' + tile[1], file=sys.stderr)
+            continue
+        done += 1
+        print(worker + ' : ' + tile[1])
+
+    if finalize(conn, meta):
+        print(worker + ' : VRT et pyramides construits : ' + meta['output'])
+    conn.close()
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Worker de l'exécution distribuée de Histogram Matching")
+    parser.add_argument('queue', help='base SQLite publiée par l\'algorithme')
+    parser.add_argument('--lease', type=float, default=600, help='durée du bail d\'une dalle en secondes')
+    parser.add_argument('--max-attempts', type=int, default=3, help='nombre d\'essais avant d\'abandonner une dalle')
+    parser.add_argument('--wait', action='store_true', help='attendre les dalles encore réservées par d\'autres workers')
+    parser.add_argument('--poll', type=float, default=5, help='intervalle d\'attente en secondes avec --wait')
+    args = parser.parse_args(argv)
+
+    gdal.UseExceptions()
+    work(args.queue, args.lease, args.max_attempts, args.poll, args.wait)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
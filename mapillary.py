@@ -18,14 +18,41 @@ from qgis.core import (QgsProcessing,
                        QgsLayoutExporter,
                        QgsProcessingParameterFileDestination,
                        QgsProcessingParameterNumber,
-                       QgsProcessingParameterVectorLayer
+                       QgsProcessingParameterVectorLayer,
+                       QgsFeatureRequest,
+                       QgsLineString,
+                       QgsWkbTypes,
+                       QgsField,
+                       QgsFields,
+                       QgsProcessingParameterString,
+                       QgsProcessingParameterFile,
+                       QgsProcessingParameterFeatureSink
                        )
+from PyQt5.QtCore import QVariant
 import processing, subprocess
+import numpy as np
 from qgis.utils import iface
+import os
+import sys
+
+# les modules partagés sont à côté des scripts, dossier que QGIS n'ajoute pas à sys.path
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+if SCRIPT_DIR not in sys.path:
+    sys.path.insert(0, SCRIPT_DIR)
+from mapillaryClient import ImageGridIndex, MapillaryClient, coveringTiles
+
 
 class MapillaryAlgorithm(QgsProcessingAlgorithm):
     
     LAYER= 'LAYER'
+    TOKEN = 'TOKEN'
+    DISTANCE = 'DISTANCE'
+    CACHE = 'CACHE'
+    OUTPUT = 'OUTPUT'
+    CHUNK_SIZE = 50000
+    MIN_DISTANCE = 0.1
+    TILE_SIZE = 0.01
+    API_URL = 'https://graph.mapillary.com'
     
     def tr(self, string):
         """
@@ -65,7 +92,36 @@ class MapillaryAlgorithm(QgsProcessingAlgorithm):
 
     def initAlgorithm(self, config=None):
         self.addParameter( 
-        QgsProcessingParameterVectorLayer(self.LAYER)
+        QgsProcessingParameterVectorLayer(self.LAYER, types=[QgsProcessing.TypeVectorPoint])
+        )
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.TOKEN,
+                self.tr("Jeton d'accès Mapillary")
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.DISTANCE,
+                self.tr('Distance maximale (m)'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue = 20,
+                minValue = self.MIN_DISTANCE
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.CACHE,
+                self.tr('Dossier de cache des réponses'),
+                behavior=QgsProcessingParameterFile.Folder,
+                optional=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT,
+                self.tr('Points avec image Mapillary')
+            )
         )
     
     
@@ -74,14 +130,127 @@ class MapillaryAlgorithm(QgsProcessingAlgorithm):
         wgsCRS= QgsCoordinateReferenceSystem(4326)
         
         p = QgsProject()
-        projectCRS = p.instance().crs()
-        xform= QgsCoordinateTransform(projectCRS,wgsCRS,p)
 
         layout = QgsLayout(p)
         layout.initializeDefaults()
 
         layer = self.parameterAsVectorLayer(parameters,self.LAYER, context)
-        return {}
+        # les coordonnées des entités sont dans le SCR de la couche, pas celui du projet
+        xform= QgsCoordinateTransform(layer.crs(),wgsCRS,p.instance())
+
+        token = self.parameterAsString(parameters, self.TOKEN, context)
+        max_distance = self.parameterAsDouble(parameters, self.DISTANCE, context)
+        cache_dir = self.parameterAsFile(parameters, self.CACHE, context)
+
+        if max_distance < self.MIN_DISTANCE:
+            raise QgsProcessingException(self.tr('La distance maximale doit être strictement positive'))
+
+        # la couche est parcourue deux fois plutôt que de garder tous ses points en mémoire
+        bboxes, nb_points = self.getTiles(self.getPointFromLayer(layer, xform, feedback), max_distance)
+        feedback.pushInfo(str(nb_points)+' points extraits')
+        if feedback.isCanceled():
+            return {}
+
+        feedback.pushInfo(str(len(bboxes))+' tuiles à interroger')
+        client = MapillaryClient(token, self.API_URL, cache_dir or None)
+        try:
+            ids, img_lons, img_lats, dates = client.fetchTiles(bboxes, feedback)
+        except RuntimeError as e:
+            raise QgsProcessingException(str(e))
+        feedback.pushInfo(str(len(ids))+' images trouvées ('+str(client.requests)+' requêtes, '+str(client.cache_hits)+' en cache)')
+        if client.truncated:
+            feedback.pushWarning(str(client.truncated)+' tuiles restent tronquées par la limite de l\'API, des images peuvent manquer')
+        if feedback.isCanceled():
+            return {}
+
+        index = ImageGridIndex(img_lons, img_lats, max_distance)
+        matches = {}
+        for fids, lons, lats in self.getPointFromLayer(layer, xform, feedback):
+            nearest, distances = index.nearest(lons, lats)
+            for fid, image, distance in zip(fids.tolist(), nearest.tolist(), distances.tolist()):
+                # entités multipoints : on garde la partie la plus proche
+                if image >= 0 and (fid not in matches or distance < matches[fid][1]):
+                    matches[fid] = (image, distance)
+
+        fields = QgsFields(layer.fields())
+        fields.append(QgsField('mly_image', QVariant.String))
+        fields.append(QgsField('mly_distance', QVariant.Double))
+        fields.append(QgsField('mly_captured_at', QVariant.LongLong))
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
+                                               fields, layer.wkbType(), layer.crs())
+        for feature in layer.getFeatures():
+            if feedback.isCanceled():
+                break
+            attributes = feature.attributes()
+            if feature.id() in matches:
+                image, distance = matches[feature.id()]
+                attributes += [str(ids[image]), distance, int(dates[image])]
+            else:
+                attributes += [None, None, None]
+            feature.setFields(fields, False)
+            feature.setAttributes(attributes)
+            sink.addFeature(feature, QgsFeatureSink.FastInsert)
 
-    def getPointFromLayer(self, layer):
-        ...
\ No newline at end of file
+        return {self.OUTPUT: dest_id}
+
+    def getTiles(self, chunks, max_distance):
+        """
+        Groups the points into TILE_SIZE degree tiles and returns the bboxes
+        of the tiles covering every point and its search radius, with the
+        number of points. Only the tile keys of each chunk are kept.
+        """
+        tiles = np.empty((0, 2), dtype=np.int64)
+        nb_points = 0
+        for fids, lons, lats in chunks:
+            nb_points += len(fids)
+            keys = coveringTiles(lons, lats, max_distance, self.TILE_SIZE)
+            tiles = np.unique(np.concatenate((tiles, keys)), axis=0)
+        bboxes = [(i * self.TILE_SIZE, j * self.TILE_SIZE, (i + 1) * self.TILE_SIZE, (j + 1) * self.TILE_SIZE)
+                  for i, j in tiles.tolist()]
+        return (bboxes, nb_points)
+
+    def getPointFromLayer(self, layer, xform, feedback=None, chunk_size=None):
+        """
+        Extracts the points of the layer by chunks and reprojects them with xform.
+        Yields (fids, x, y) tuples of numpy arrays, one per chunk of at most
+        chunk_size points. Attributes are not fetched and the transformation
+        is applied once per chunk instead of once per feature.
+        """
+        if chunk_size is None:
+            chunk_size = self.CHUNK_SIZE
+
+        request = QgsFeatureRequest()
+        request.setNoAttributes()
+
+        fids = np.empty(chunk_size, dtype=np.int64)
+        xs = np.empty(chunk_size, dtype=np.float64)
+        ys = np.empty(chunk_size, dtype=np.float64)
+        n = 0
+        for feature in layer.getFeatures(request):
+            if feedback is not None and feedback.isCanceled():
+                return
+            geom = feature.geometry()
+            if geom.isNull() or geom.type() != QgsWkbTypes.PointGeometry:
+                continue
+            for point in geom.vertices():
+                fids[n] = feature.id()
+                xs[n] = point.x()
+                ys[n] = point.y()
+                n += 1
+                if n == chunk_size:
+                    yield self.transformPoints(fids, xs, ys, n, xform)
+                    n = 0
+        if n:
+            yield self.transformPoints(fids, xs, ys, n, xform)
+
+    def transformPoints(self, fids, xs, ys, n, xform):
+        """
+        Reprojects the n first coordinates in a single call by loading them
+        in a QgsLineString, whose transform works on the whole coordinate arrays.
+        """
+        line = QgsLineString(xs[:n].tolist(), ys[:n].tolist())
+        if xform.isValid() and not xform.isShortCircuited():
+            line.transform(xform)
+        return (fids[:n].copy(),
+                np.array(line.xVector(), dtype=np.float64),
+                np.array(line.yVector(), dtype=np.float64))
\ No newline at end of file
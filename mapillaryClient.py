@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Client de l'API Mapillary et index des positions d'images utilisés par le
+script 'mapillary'. Seul numpy est nécessaire, QGIS n'est pas requis, ce qui
+permet de tester le client contre un serveur local.
+"""
+
+import asyncio
+import hashlib
+import http.client
+import json
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+import numpy as np
+
+
+class MapillaryClient:
+    """
+    Asynchronous client for the Mapillary graph API.
+    Requests go through a pool of keep-alive HTTP connections, their number
+    being the concurrency limit. Failed requests are retried with an
+    exponential backoff and successful responses are cached on disk.
+    """
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    PAGE_SIZE = 2000
+    MAX_SPLIT = 4
+
+    def __init__(self, token, api_url='https://graph.mapillary.com', cache_dir=None,
+                 max_connections=8, max_retries=4, timeout=30, page_size=None):
+        self.token = token
+        url = urlsplit(api_url)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.base_path = url.path.rstrip('/')
+        self.cache_dir = cache_dir
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.page_size = page_size or self.PAGE_SIZE
+        self.pool = queue.LifoQueue()
+        self.requests = 0
+        self.cache_hits = 0
+        self.truncated = 0
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def newConnection(self):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def get(self, path):
+        """
+        Blocking GET on a pooled connection, returns (status, body).
+        """
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn = self.newConnection()
+        try:
+            conn.request('GET', path, headers={'Authorization': 'OAuth ' + self.token})
+            response = conn.getresponse()
+            body = response.read()
+        except Exception:
+            conn.close()
+            raise
+        self.pool.put(conn)
+        return (response.status, body)
+
+    def cachePath(self, path):
+        if not self.cache_dir:
+            return None
+        return os.path.join(self.cache_dir, hashlib.sha1(path.encode('utf-8')).hexdigest() + '.json')
+
+    async def fetch(self, path, executor, semaphore):
+        cache_path = self.cachePath(path)
+        if cache_path and os.path.exists(cache_path):
+            self.cache_hits += 1
+            with open(cache_path, 'r') as f:
+                return json.load(f)
+
+        loop = asyncio.get_event_loop()
+        for attempt in range(self.max_retries + 1):
+            async with semaphore:
+                try:
+                    self.requests += 1
+                    status, body = await loop.run_in_executor(executor, self.get, path)
+                except (OSError, http.client.HTTPException):
+                    status, body = None, None
+            if status == 200:
+                data = json.loads(body.decode('utf-8'))
+                if cache_path:
+                    tmp_path = cache_path + '.tmp'
+                    with open(tmp_path, 'w') as f:
+                        json.dump(data, f)
+                    os.replace(tmp_path, cache_path)
+                return data
+            if status is not None and status not in self.RETRY_STATUS:
+                raise RuntimeError('Mapillary : erreur HTTP ' + str(status) + ' sur ' + path)
+            await asyncio.sleep(0.5 * 2 ** attempt)
+        raise RuntimeError('Mapillary : échec de la requête ' + path)
+
+    def imagesPath(self, bbox):
+        query = urlencode({
+            'fields': 'id,computed_geometry,captured_at',
+            'bbox': ','.join(repr(float(v)) for v in bbox),
+            'limit': self.page_size
+        })
+        return self.base_path + '/images?' + query
+
+    def nextPath(self, data):
+        """
+        Returns the request path of the next page of a response, None on the
+        last page.
+        """
+        url = (data.get('paging') or {}).get('next')
+        if not url:
+            return None
+        url = urlsplit(url)
+        return url.path + ('?' + url.query if url.query else '')
+
+    def splitBbox(self, bbox):
+        xmin, ymin, xmax, ymax = bbox
+        xmid = (xmin + xmax) / 2
+        ymid = (ymin + ymax) / 2
+        return [(xmin, ymin, xmid, ymid), (xmid, ymin, xmax, ymid),
+                (xmin, ymid, xmid, ymax), (xmid, ymid, xmax, ymax)]
+
+    async def fetchTile(self, bbox, executor, semaphore, depth=0):
+        """
+        Fetches every image of a tile, following the next page cursor. A full
+        page without cursor means the API truncated the answer: the tile is
+        split in four, up to MAX_SPLIT times.
+        """
+        path = self.imagesPath(bbox)
+        images = []
+        first_page = True
+        while path:
+            data = await self.fetch(path, executor, semaphore)
+            page = data.get('data', [])
+            path = self.nextPath(data)
+            if first_page and path is None and len(page) >= self.page_size:
+                if depth < self.MAX_SPLIT:
+                    parts = await asyncio.gather(*[self.fetchTile(part, executor, semaphore, depth + 1)
+                                                   for part in self.splitBbox(bbox)])
+                    return [image for part in parts for image in part]
+                self.truncated += 1
+            first_page = False
+            for image in page:
+                geometry = image.get('computed_geometry') or image.get('geometry')
+                if geometry is None:
+                    continue
+                lon, lat = geometry['coordinates'][:2]
+                images.append((image['id'], lon, lat, image.get('captured_at', 0)))
+        return images
+
+    def fetchTiles(self, bboxes, feedback=None):
+        """
+        Fetches the images of every tile.
+        Returns (ids, lons, lats, captured_at) numpy arrays, an image lying on
+        the border of several tiles being returned once.
+        """
+        async def run():
+            semaphore = asyncio.Semaphore(self.max_connections)
+            with ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+                tasks = [asyncio.ensure_future(self.fetchTile(bbox, executor, semaphore)) for bbox in bboxes]
+                images = {}
+                done = 0
+                try:
+                    for task in asyncio.as_completed(tasks):
+                        for image in await task:
+                            images[image[0]] = image
+                        done += 1
+                        if feedback is not None:
+                            feedback.setProgress(int(done * 100 / len(tasks)))
+                            if feedback.isCanceled():
+                                break
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                return list(images.values())
+
+        loop = asyncio.new_event_loop()
+        try:
+            images = loop.run_until_complete(run())
+        finally:
+            loop.close()
+            self.close()
+        if not images:
+            return (np.empty(0, dtype=object), np.empty(0), np.empty(0), np.empty(0, dtype=np.int64))
+        ids, lons, lats, dates = zip(*images)
+        return (np.array(ids, dtype=object), np.array(lons, dtype=np.float64),
+                np.array(lats, dtype=np.float64), np.array(dates, dtype=np.int64))
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def coveringTiles(lons, lats, max_distance, tile_size):
+    """
+    Returns the (i, j) keys of every tile_size degree tile intersecting the
+    search box of a point, max_distance metres around it, for all points.
+    """
+    tile_count = int(round(180 / tile_size))
+    radius_lat = max_distance / 111320.0
+    radius_lon = radius_lat / np.maximum(np.cos(np.radians(lats)), 1e-6)
+    # toutes les tuiles entre les coins de la boîte, pas seulement les coins
+    i0 = np.clip(np.floor((lons - radius_lon) / tile_size), -tile_count, tile_count - 1).astype(np.int64)
+    i1 = np.clip(np.floor((lons + radius_lon) / tile_size), -tile_count, tile_count - 1).astype(np.int64)
+    j0 = np.clip(np.floor((lats - radius_lat) / tile_size), -tile_count // 2, tile_count // 2 - 1).astype(np.int64)
+    j1 = np.clip(np.floor((lats + radius_lat) / tile_size), -tile_count // 2, tile_count // 2 - 1).astype(np.int64)
+    rows = j1 - j0 + 1
+    counts = (i1 - i0 + 1) * rows
+    total = counts.sum()
+    point_idx = np.repeat(np.arange(len(lons)), counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    i = i0[point_idx] + offsets // rows[point_idx]
+    j = j0[point_idx] + offsets % rows[point_idx]
+    return np.unique(np.stack((i, j), axis=1), axis=0)
+
+
+class ImageGridIndex:
+    """
+    In-memory grid index of image positions (WGS84).
+    Cells are at least max_distance wide so the nearest image of a point,
+    if closer than max_distance, lies in one of the 3x3 neighbouring cells.
+    Queries are vectorized over whole chunks of points.
+    """
+
+    EARTH_RADIUS = 6371008.8
+
+    def __init__(self, lons, lats, max_distance):
+        if not max_distance > 0:
+            raise ValueError('La distance maximale doit être strictement positive')
+        self.max_distance = max_distance
+        max_lat = np.max(np.abs(lats)) if len(lats) else 0
+        meters_per_degree = np.pi * self.EARTH_RADIUS / 180
+        self.cell_lat = max_distance / meters_per_degree
+        self.cell_lon = max_distance / (meters_per_degree * max(np.cos(np.radians(min(max_lat + self.cell_lat, 89.9))), 1e-6))
+
+        keys = self.cellKeys(lons, lats)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+        self.lons = lons[self.order]
+        self.lats = lats[self.order]
+
+    def cellKeys(self, lons, lats, di=0, dj=0):
+        i = np.floor(lons / self.cell_lon).astype(np.int64) + di
+        j = np.floor(lats / self.cell_lat).astype(np.int64) + dj
+        # codage de (i, j) sur un seul entier pour le tri et la recherche
+        return i * 4294967296 + j
+
+    def nearest(self, lons, lats):
+        """
+        Returns (indices, distances) of the nearest image of each point, the
+        indices refering to the arrays given to the constructor, -1 when no
+        image lies within max_distance.
+        """
+        n = len(lons)
+        best = np.full(n, -1, dtype=np.int64)
+        best_distance = np.full(n, np.inf)
+        if n == 0 or len(self.keys) == 0:
+            return (best, best_distance)
+
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                keys = self.cellKeys(lons, lats, di, dj)
+                start = np.searchsorted(self.keys, keys, side='left')
+                end = np.searchsorted(self.keys, keys, side='right')
+                counts = end - start
+                total = counts.sum()
+                if total == 0:
+                    continue
+                point_idx = np.repeat(np.arange(n), counts)
+                offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                image_idx = np.repeat(start, counts) + offsets
+
+                distances = self.distance(lons[point_idx], lats[point_idx], self.lons[image_idx], self.lats[image_idx])
+                # plus proche candidat par point : tri par point puis par distance,
+                # le premier candidat de chaque point est retenu
+                order = np.lexsort((distances, point_idx))
+                points, first = np.unique(point_idx[order], return_index=True)
+                candidate = np.full(n, -1, dtype=np.int64)
+                candidate_distance = np.full(n, np.inf)
+                candidate[points] = image_idx[order[first]]
+                candidate_distance[points] = distances[order[first]]
+
+                better = candidate_distance < best_distance
+                best[better] = candidate[better]
+                best_distance[better] = candidate_distance[better]
+
+        best[best_distance > self.max_distance] = -1
+        found = best >= 0
+        best[found] = self.order[best[found]]
+        return (best, best_distance)
+
+    def distance(self, lon1, lat1, lon2, lat2):
+        # approximation équirectangulaire, suffisante pour quelques dizaines de mètres
+        lat_mean = np.radians((lat1 + lat2) / 2)
+        dx = np.radians(lon2 - lon1) * np.cos(lat_mean)
+        dy = np.radians(lat2 - lat1)
+        return self.EARTH_RADIUS * np.sqrt(dx * dx + dy * dy)
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Outils communs aux scripts raster (Histogram Matching, Egalisation
+Colorimétrique, To 8 Bits From Style, ...). Ce module ne contient pas
+d'algorithme, il doit être placé à côté des scripts qui l'importent.
+"""
+
+from qgis.core import (QgsRasterLayer,
+                       QgsCoordinateTransform,
+                       QgsProcessingUtils,
+                       QgsProcessingException)
+from osgeo import gdal
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import math
+import os
+import uuid
+
+
+class QuantileSketch:
+    """
+    Relative error quantile sketch for float rasters: each value goes to a
+    logarithmic bucket, the value returned for a bucket being within
+    ACCURACY of the values it holds. Bucket keys are ordered as the values,
+    so that the sketches are histograms merged by HistogramEngine.
+    """
+
+    ACCURACY = 0.005
+    MIN_VALUE = 1e-9
+
+    def __init__(self):
+        self.gamma = (1+self.ACCURACY)/(1-self.ACCURACY)
+        self.offset = int(math.ceil(-math.log(self.MIN_VALUE)/math.log(self.gamma)))
+
+    def binValues(self, values):
+        
+        values = values[np.isfinite(values)].astype(np.float64)
+        if values.size == 0:
+            return (0, np.zeros(0, dtype=np.int64))
+        magnitude = np.abs(values)
+        # 0 pour les valeurs quasi nulles, puis négatifs et positifs de part et d'autre
+        keys = np.zeros(values.shape, dtype=np.int64)
+        significant = magnitude >= self.MIN_VALUE
+        keys[significant] = np.ceil(np.log(magnitude[significant])/math.log(self.gamma)).astype(np.int64)+self.offset+1
+        keys = np.where(values < 0, -keys, keys)
+        first = int(keys.min())
+        return (first, np.bincount(keys-first))
+
+    def value(self, key):
+        
+        if key == 0:
+            return 0.0
+        index = abs(key)-self.offset-1
+        value = 2*self.gamma**index/(self.gamma+1)
+        return value if key > 0 else -value
+
+
+class HistogramEngine:
+    """
+    Computes the histograms of several bands of a GDAL raster by chunks of
+    block rows on a thread pool, then merges the partial histograms. GDAL
+    releases the GIL while reading, decompressing or warping the blocks.
+    
+    Pixels masked by the mask band of GDAL (nodata value, then alpha band)
+    are ignored. Integer rasters get one bin per value, float rasters need an
+    explicit (minimum, maximum, bins) binning or a QuantileSketch. A
+    histogram is a tuple (first, counts), counts[i] being the count of the
+    bin first+i.
+    """
+
+    CHUNK_ROWS = 512
+
+    def __init__(self, workers=None, feedback=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.feedback = feedback
+
+    def chunks(self, ds):
+        
+        block_y = ds.GetRasterBand(1).GetBlockSize()[1]
+        rows = max(block_y, self.CHUNK_ROWS//block_y*block_y)
+        return [(row, min(rows, ds.RasterYSize-row)) for row in range(0, ds.RasterYSize, rows)]
+
+    def binValues(self, values, binning):
+        
+        if isinstance(binning, QuantileSketch):
+            return binning.binValues(values)
+        if binning is not None:
+            (minimum, maximum, bins) = binning
+            values = values[~np.isnan(values)]
+            # les valeurs hors de l'intervalle vont dans les classes extrêmes
+            index = np.clip(((values-minimum)*(bins/(maximum-minimum))).astype(np.int64), 0, bins-1)
+            return (0, np.bincount(index, minlength=bins))
+        if values.size == 0:
+            return (0, np.zeros(0, dtype=np.int64))
+        first = int(values.min())
+        return (first, np.bincount((values.astype(np.int64)-first).ravel()))
+
+    def accumulate(self, path, bands, binning, row, rows):
+        """
+        Returns the partial histograms of bands for rows [row, row+rows).
+        Each call opens its own dataset, GDAL handles not being thread safe.
+        """
+        ds = gdal.Open(path, gdal.GA_ReadOnly)
+        dataset_valid = None
+        histograms = []
+        for band in bands:
+            raster_band = ds.GetRasterBand(band)
+            values = raster_band.ReadAsArray(0, row, ds.RasterXSize, rows)
+            flags = raster_band.GetMaskFlags()
+            if flags & gdal.GMF_ALL_VALID:
+                valid = None
+            elif flags & gdal.GMF_PER_DATASET and dataset_valid is not None:
+                valid = dataset_valid
+            else:
+                valid = raster_band.GetMaskBand().ReadAsArray(0, row, ds.RasterXSize, rows) == 255
+                if flags & gdal.GMF_PER_DATASET:
+                    dataset_valid = valid
+            histograms.append(self.binValues(values.ravel() if valid is None else values[valid], binning))
+        ds = None
+        return histograms
+
+    def merge(self, histogram, partial):
+        
+        if len(histogram[1]) == 0:
+            return partial
+        if len(partial[1]) == 0:
+            return histogram
+        first = min(histogram[0], partial[0])
+        last = max(histogram[0]+len(histogram[1]), partial[0]+len(partial[1]))
+        counts = np.zeros(last-first, dtype=np.int64)
+        for (start, values) in (histogram, partial):
+            counts[start-first:start-first+len(values)] += values
+        return (first, counts)
+
+    def compute(self, path, bands, binning=None):
+        """
+        Returns the histograms of bands, or None when the feedback is canceled.
+        """
+        ds = gdal.Open(path, gdal.GA_ReadOnly)
+        if ds is None:
+            raise QgsProcessingException('Impossible d\'ouvrir '+path)
+        chunks = self.chunks(ds)
+        ds = None
+        
+        histograms = [(0, np.zeros(0, dtype=np.int64)) for band in bands]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.accumulate, path, bands, binning, row, rows) for (row, rows) in chunks]
+            try:
+                for future in as_completed(futures):
+                    if self.feedback is not None and self.feedback.isCanceled():
+                        return None
+                    histograms = [self.merge(histogram, partial) for (histogram, partial) in zip(histograms, future.result())]
+            finally:
+                for future in futures:
+                    future.cancel()
+        return histograms
+
+    def valueVector(self, histogram, length=0):
+        """
+        Returns the counts indexed by value, from 0 to at least length-1,
+        as the histogramVector of a QGIS provider. Negative values are dropped.
+        """
+        (first, counts) = histogram
+        if first < 0:
+            counts = counts[-first:]
+            first = 0
+        vector = np.zeros(max(length, first+len(counts)), dtype=np.int64)
+        vector[first:first+len(counts)] = counts
+        return vector
+
+
+def dataBands(path):
+    """
+    Returns the numbers of the bands of the GDAL raster path holding data,
+    that is every band but the alpha bands (GCI_AlphaBand colour
+    interpretation), wherever they are.
+    """
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    if ds is None:
+        raise QgsProcessingException('Impossible d\'ouvrir '+path)
+    bands = [band for band in range(1, ds.RasterCount+1)
+             if ds.GetRasterBand(band).GetColorInterpretation() != gdal.GCI_AlphaBand]
+    ds = None
+    return bands
+
+
+def colorInterpretations(path, bands):
+    """
+    Returns the GDAL names of the colour interpretations of bands in the
+    raster path, to label the output bands as their source. Alpha and
+    palette bands, whose meaning is lost by the remapping, are Undefined.
+    """
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    if ds is None:
+        raise QgsProcessingException('Impossible d\'ouvrir '+path)
+    interps = []
+    for band in bands:
+        interp = ds.GetRasterBand(band).GetColorInterpretation()
+        if interp in (gdal.GCI_AlphaBand, gdal.GCI_PaletteIndex):
+            interp = gdal.GCI_Undefined
+        interps.append(gdal.GetColorInterpretationName(interp))
+    ds = None
+    return interps
+
+
+def lutFromHistograms(ref_hist, match_hist, pourcent_desaturation, pourcent_saturation):
+    """
+    Returns the histogram matching table of match_hist onto ref_hist, both
+    indexed by value and of any length: vectorized equivalent of
+    getDesaturationTuple and getRefValue of Histogram Matching. The int64
+    values are not clipped to an output type.
+    """
+    ref_cumulhist = np.cumsum(ref_hist).astype(np.float64)
+    match_cumulhist = np.cumsum(match_hist).astype(np.float64)
+    ref_norm = ref_cumulhist/ref_cumulhist[-1]
+    match_norm = match_cumulhist/match_cumulhist[-1]
+
+    max_ref = len(ref_cumulhist)
+    max_match = np.searchsorted(match_cumulhist, match_cumulhist[-1]-(match_cumulhist[-1]*pourcent_saturation/100))
+    min_ref = int(max_ref-(max_ref*pourcent_desaturation/100))
+    min_match = np.searchsorted(match_norm, ref_norm[min(min_ref, max_ref-1)])
+    if pourcent_desaturation > 0 :
+        pas_match = (max_match - min_match)/pourcent_desaturation
+        pas_ref = (max_ref - min_ref)/pourcent_desaturation
+    else :
+        pas_match = pas_ref = 0
+
+    indices = np.arange(len(match_cumulhist))
+    values = np.minimum(np.searchsorted(ref_norm, match_norm), min_ref).astype(np.int64)
+    desaturated = values == min_ref
+    if pas_match != 0 :
+        values[desaturated] = (min_ref + (indices[desaturated]-min_match)/pas_match*pas_ref).astype(np.int64)
+    return values
+
+
+class IntermediateStorage:
+    """
+    Intermediate rasters of a processing algorithm, kept in /vsimem/ when
+    they are small enough. Mixed in the algorithms, which provide the MASK
+    parameter and initialise self.intermediates to an empty list.
+    """
+
+    MEMORY_THRESHOLD = 1024*1024*1024
+
+    def intermediatePath(self, name, estimated_size):
+        """
+        Returns a /vsimem/ path for intermediates smaller than MEMORY_THRESHOLD,
+        a temporary file otherwise. Paths are removed by cleanIntermediates.
+        """
+        if estimated_size <= self.MEMORY_THRESHOLD:
+            path = '/vsimem/'+self.name()+'_'+uuid.uuid4().hex+'_'+name+'.tif'
+        else:
+            path = QgsProcessingUtils.generateTempFilename(name+'.tif')
+        self.intermediates.append(path)
+        return path
+
+    def cleanIntermediates(self, feedback):
+
+        saved = 0
+        for path in self.intermediates:
+            if path.startswith('/vsimem/'):
+                stat = gdal.VSIStatL(path)
+                if stat is not None:
+                    saved += stat.size
+                gdal.Unlink(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        self.intermediates = []
+        if saved:
+            # chaque intermédiaire aurait été écrit puis relu
+            feedback.pushInfo('E/S disque évitées : '+str(round(2*saved/1048576, 1))+' Mo')
+
+    def gdalCallback(self, feedback):
+        return lambda complete, message, data: 0 if feedback.isCanceled() else 1
+
+    def estimateSize(self, extent, pixel_x, pixel_y, nb_bands, data_size, layer_extent=None):
+
+        if layer_extent is not None:
+            extent = extent.intersect(layer_extent)
+        return int(extent.width()/pixel_x) * int(extent.height()/pixel_y) * nb_bands * data_size
+
+    def clipRaster(self, name, layer_name, parameters, context, feedback):
+        """
+        Clips the raster layer_name by the MASK layer in process, the result
+        being kept in memory when it is small enough.
+        """
+        layer = self.parameterAsRasterLayer(parameters, layer_name, context)
+        mask = self.parameterAsSource(parameters, self.MASK, context)
+        mask_path = self.parameterAsCompatibleSourceLayerPath(parameters, self.MASK, context, ['shp', 'gpkg'], 'gpkg', feedback)
+        mask_extent = QgsCoordinateTransform(mask.sourceCrs(), layer.crs(), context.transformContext()).transformBoundingBox(mask.sourceExtent())
+        provider = layer.dataProvider()
+        path = self.intermediatePath(name, self.estimateSize(
+            mask_extent, layer.rasterUnitsPerPixelX(), layer.rasterUnitsPerPixelY(),
+            layer.bandCount()+1, provider.dataTypeSize(1), layer.extent()))
+
+        ds = gdal.Warp(path, layer.source(), format='GTiff', cutlineDSName=mask_path, cropToCutline=True,
+                       dstNodata=0, dstAlpha=True, callback=self.gdalCallback(feedback))
+        if ds is None and not feedback.isCanceled():
+            raise QgsProcessingException(self.tr('Échec du découpage de ')+layer.name())
+        ds = None
+        return QgsRasterLayer(path, name)
+
+    def warpRaster(self, name, layer_name, grid, parameters, context, feedback):
+        """
+        Wraps the raster layer_name in a warped VRT aligned on the pixel grid
+        of the raster layer grid and cut by the MASK layer. No pixel is
+        computed here: GDAL reprojects the blocks read by the histograms.
+        """
+        layer = self.parameterAsRasterLayer(parameters, layer_name, context)
+        mask_path = self.parameterAsCompatibleSourceLayerPath(parameters, self.MASK, context, ['shp', 'gpkg'], 'gpkg', feedback)
+        extent = grid.extent()
+        path = '/vsimem/'+self.name()+'_'+uuid.uuid4().hex+'_'+name+'.vrt'
+        self.intermediates.append(path)
+
+        # plus proche voisin : les valeurs de la référence sont conservées
+        ds = gdal.Warp(path, layer.source(), format='VRT', dstSRS=grid.crs().toWkt(),
+                       outputBounds=(extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum()),
+                       width=grid.width(), height=grid.height(), resampleAlg='near',
+                       cutlineDSName=mask_path, dstNodata=0, dstAlpha=True)
+        if ds is None:
+            raise QgsProcessingException(self.tr('Échec de la reprojection de ')+layer.name())
+        ds = None
+        return QgsRasterLayer(path, name)
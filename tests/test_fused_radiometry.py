@@ -0,0 +1,127 @@
+"""
+The fused radiometry pipeline against the chain it replaces: To 8 Bits From
+Style, then Histogram Matching on a reference. Needs QGIS and GDAL.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+qgis_core = pytest.importorskip('qgis.core')
+gdal = pytest.importorskip('osgeo.gdal')
+ogr = pytest.importorskip('osgeo.ogr')
+osr = pytest.importorskip('osgeo.osr')
+
+from qgis.core import (Qgis,
+                       QgsApplication,
+                       QgsContrastEnhancement,
+                       QgsMultiBandColorRenderer,
+                       QgsProcessingContext,
+                       QgsProcessingFeedback,
+                       QgsRasterLayer)
+
+# emprise à 6 chiffres, calée sur la grille des dalles de 5 km
+XMIN = 650000
+YMAX = 552000
+PIXEL = 10
+SIZE = 200
+BOUNDS = [(1000, 3001), (800, 2601), (1200, 3401)]
+
+
+@pytest.fixture(scope='module')
+def qgis_app():
+    QgsApplication.setPrefixPath(os.environ.get('QGIS_PREFIX_PATH', '/usr'), True)
+    app = QgsApplication([], False)
+    app.initQgis()
+    sys.path.append(os.path.join(QgsApplication.pkgDataPath(), 'python', 'plugins'))
+    from processing.core.Processing import Processing
+    Processing.initialize()
+    yield app
+    app.exitQgis()
+
+
+def createRaster(path, values, data_type):
+    ds = gdal.GetDriverByName('GTiff').Create(path, SIZE, SIZE, len(values), data_type)
+    ds.SetGeoTransform([XMIN, PIXEL, 0, YMAX, 0, -PIXEL])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(2154)
+    ds.SetProjection(srs.ExportToWkt())
+    for (index, band) in enumerate(values):
+        ds.GetRasterBand(index + 1).WriteArray(band)
+    ds = None
+
+
+def createMask(path):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(2154)
+    ds = ogr.GetDriverByName('GPKG').CreateDataSource(path)
+    layer = ds.CreateLayer('mask', srs, ogr.wkbPolygon)
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(ogr.CreateGeometryFromWkt(
+        'POLYGON ((650200 550200, 651800 550200, 651800 551800, 650200 551800, 650200 550200))'))
+    layer.CreateFeature(feature)
+    ds = None
+
+
+def styledLayer(path):
+    layer = QgsRasterLayer(path, 'source')
+    renderer = QgsMultiBandColorRenderer(layer.dataProvider(), 1, 2, 3)
+    setters = (renderer.setRedContrastEnhancement, renderer.setGreenContrastEnhancement, renderer.setBlueContrastEnhancement)
+    for (setter, (minimum, maximum)) in zip(setters, BOUNDS):
+        enhancement = QgsContrastEnhancement(Qgis.UInt16)
+        enhancement.setContrastEnhancementAlgorithm(QgsContrastEnhancement.StretchToMinimumMaximum)
+        enhancement.setMinimumValue(minimum)
+        enhancement.setMaximumValue(maximum)
+        setter(enhancement)
+    layer.setRenderer(renderer)
+    return layer
+
+
+def runAlgorithm(algorithm, parameters):
+    context = QgsProcessingContext()
+    feedback = QgsProcessingFeedback()
+    (results, ok) = algorithm.run(parameters, context, feedback)
+    assert ok, results
+    return results
+
+
+def test_fused_output_matches_chained_output(qgis_app, tmp_path):
+    from FusedRadiometry import FusedRadiometry
+    from HistogramMatching import HistogramMatching
+    from To8BitsFromStyle import To8BitsFromStyle
+
+    rng = np.random.default_rng(11)
+    source_path = str(tmp_path / 'source.tif')
+    createRaster(source_path, rng.integers(600, 3600, (3, SIZE, SIZE)).astype(np.uint16), gdal.GDT_UInt16)
+    reference_path = str(tmp_path / 'reference.tif')
+    reference = np.clip(rng.normal(120, 40, (3, SIZE, SIZE)), 0, 255).astype(np.uint8)
+    createRaster(reference_path, reference, gdal.GDT_Byte)
+    mask_path = str(tmp_path / 'mask.gpkg')
+    createMask(mask_path)
+    source = styledLayer(source_path)
+
+    eight_bits = str(tmp_path / 'huit_bits.tif')
+    runAlgorithm(To8BitsFromStyle(), {'INPUT': source, 'MASK': mask_path, 'OUTPUT': eight_bits})
+    matched = str(tmp_path / 'matching.vrt')
+    runAlgorithm(HistogramMatching(), {'INPUT': eight_bits, 'REFERENCE': reference_path, 'MASK': mask_path,
+                                       'DECOUPE': mask_path, 'DESATURATION': 1, 'SATURATION': 0, 'OUTPUT': matched})
+    fused = str(tmp_path / 'fused.tif')
+    runAlgorithm(FusedRadiometry(), {'INPUT': source, 'MASK': mask_path, 'REFERENCE': reference_path,
+                                     'DESATURATION': 1, 'SATURATION': 0, 'OUTPUT': fused})
+
+    fused_ds = gdal.Open(fused)
+    (x0, pixel_x, _, y0, _, pixel_y) = fused_ds.GetGeoTransform()
+    fused_values = fused_ds.ReadAsArray()
+    chained_ds = gdal.Open(matched)
+    chained_gt = chained_ds.GetGeoTransform()
+    chained_values = chained_ds.ReadAsArray(int(round((x0 - chained_gt[0]) / chained_gt[1])),
+                                            int(round((y0 - chained_gt[3]) / chained_gt[5])),
+                                            fused_ds.RasterXSize, fused_ds.RasterYSize)
+
+    valid = chained_values[3] == 255
+    assert valid.sum() > 0.9 * valid.size
+    assert (fused_values[3][valid] == 255).all()
+    for index in range(3):
+        assert np.array_equal(fused_values[index][valid], chained_values[index][valid])
@@ -0,0 +1,85 @@
+"""
+End to end run of a published Histogram Matching queue by several worker
+processes. Needs GDAL.
+"""
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+ogr = pytest.importorskip('osgeo.ogr')
+osr = pytest.importorskip('osgeo.osr')
+
+import tileQueue
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKER = os.path.join(ROOT, 'histogramMatchingWorker.py')
+
+
+def createSource(path, width, height):
+    rng = np.random.default_rng(5)
+    values = rng.integers(0, 256, (3, height, width), dtype=np.uint8)
+    ds = gdal.GetDriverByName('GTiff').Create(path, width, height, 3, gdal.GDT_Byte)
+    ds.SetGeoTransform([1000, 1, 0, 2000, 0, -1])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(2154)
+    ds.SetProjection(srs.ExportToWkt())
+    for index in range(3):
+        ds.GetRasterBand(index + 1).WriteArray(values[index])
+    ds = None
+    return values
+
+
+def createMask(path, wkt):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(2154)
+    ds = ogr.GetDriverByName('GPKG').CreateDataSource(path)
+    layer = ds.CreateLayer('mask', srs, ogr.wkbPolygon)
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(ogr.CreateGeometryFromWkt(wkt))
+    layer.CreateFeature(feature)
+    ds = None
+
+
+@pytest.mark.parametrize('masked', [True, False])
+def test_workers_remap_every_tile(tmp_path, masked):
+    source = str(tmp_path / 'source.tif')
+    values = createSource(source, 300, 200)
+    tables = np.stack([255 - np.arange(256), np.arange(256) // 2, np.arange(256)]).astype(np.uint8)
+    output = str(tmp_path / 'sortie.vrt')
+    # sans couche de découpe, toute l'image est traitée
+    mask = None
+    if masked:
+        mask = str(tmp_path / 'decoupe.gpkg')
+        createMask(mask, 'POLYGON ((1000 1800, 1300 1800, 1300 2000, 1000 2000, 1000 1800))')
+    # quatre colonnes de dalles de 100 pixels : la dernière déborde de l'image
+    tiles = [('dalle_%d_%d' % (i, j), 1000 + 100 * i, 2000 - 100 * (j + 1), 1000 + 100 * (i + 1), 2000 - 100 * j,
+              str(tmp_path / ('dalle_%d_%d.tif' % (i, j))))
+             for i in range(4) for j in range(2)]
+    meta = {'source': source, 'mask': mask, 'tables': tables.tolist(), 'grid': None, 'bands': [1, 2, 3],
+            'data_type': 'Byte', 'width': 100, 'height': 100, 'pixel_x': 1.0, 'pixel_y': 1.0,
+            'epsg': 2154, 'output': output}
+    queue_path = str(tmp_path / 'sortie.sqlite')
+    tileQueue.createQueue(queue_path, meta, tiles)
+
+    workers = [subprocess.Popen([sys.executable, WORKER, queue_path, '--wait', '--poll', '0.2'],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE) for _ in range(3)]
+    for worker in workers:
+        (out, err) = worker.communicate(timeout=300)
+        assert worker.returncode == 0, err.decode()
+
+    conn = tileQueue.connect(queue_path)
+    assert tileQueue.countTiles(conn) == {'done': 8}
+    conn.close()
+
+    ds = gdal.Open(output)
+    assert (ds.RasterXSize, ds.RasterYSize, ds.RasterCount) == (400, 200, 4)
+    result = ds.ReadAsArray()
+    for index in range(3):
+        assert np.array_equal(result[index, :, :300], tables[index][values[index]])
+    assert (result[3, :, :300] == 255).all()
+    assert (result[:, :, 300:] == 0).all()
@@ -0,0 +1,204 @@
+"""
+Tests of the Mapillary client against a local server replaying a recorded
+/images response, and of the image grid index.
+"""
+
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import numpy as np
+import pytest
+
+from mapillaryClient import ImageGridIndex, MapillaryClient, coveringTiles
+
+TOKEN = 'test-token'
+RECORDED = os.path.join(os.path.dirname(__file__), 'data', 'mapillary_images.json')
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    """
+    Answers /images bbox queries with the recorded images of the bbox. The
+    API truncates full answers to 'limit' images, with a next page cursor
+    when the server pages.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.paths.append(self.path)
+            status = server.failures.pop(0) if server.failures else 200
+        if self.headers.get('Authorization') != 'OAuth ' + TOKEN:
+            status = 401
+        url = urlsplit(self.path)
+        if status == 200 and url.path != '/images':
+            status = 404
+        if status != 200:
+            return self.reply(status, {'error': {'message': 'replay error'}})
+
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        xmin, ymin, xmax, ymax = [float(v) for v in query['bbox'].split(',')]
+        limit = int(query['limit'])
+        offset = int(query.get('after', 0))
+        images = [image for image in server.images
+                  if xmin <= image['computed_geometry']['coordinates'][0] <= xmax
+                  and ymin <= image['computed_geometry']['coordinates'][1] <= ymax]
+        data = {'data': images[offset:offset + limit]}
+        if server.paging and offset + limit < len(images):
+            query['after'] = offset + limit
+            data['paging'] = {'next': 'http://%s:%d/images?%s' % (server.server_address + (urlencode(query),))}
+        self.reply(200, data)
+
+    def reply(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    with open(RECORDED) as f:
+        images = json.load(f)['data']
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), ReplayHandler)
+    httpd.images = images
+    httpd.paging = False
+    httpd.failures = []
+    httpd.paths = []
+    httpd.lock = threading.Lock()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = 'http://%s:%d' % httpd.server_address
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def recordedIds(server, bbox=(-180, -90, 180, 90)):
+    return sorted(image['id'] for image in server.images
+                  if bbox[0] <= image['computed_geometry']['coordinates'][0] <= bbox[2]
+                  and bbox[1] <= image['computed_geometry']['coordinates'][1] <= bbox[3])
+
+
+def test_fetch_tiles_returns_each_image_once(server):
+    client = MapillaryClient(TOKEN, server.url, max_connections=2)
+    bboxes = [(2.34, 48.85, 2.35, 48.87), (2.35, 48.85, 2.36, 48.87)]
+    ids, lons, lats, dates = client.fetchTiles(bboxes)
+
+    assert sorted(ids.tolist()) == recordedIds(server)
+    assert client.requests == 2
+    recorded = {image['id']: image for image in server.images}
+    for image_id, lon, lat, date in zip(ids, lons, lats, dates):
+        assert [lon, lat] == recorded[image_id]['computed_geometry']['coordinates']
+        assert date == recorded[image_id]['captured_at']
+
+
+def test_fetch_tiles_follows_next_page_cursor(server):
+    server.paging = True
+    client = MapillaryClient(TOKEN, server.url, page_size=5)
+    ids, lons, lats, dates = client.fetchTiles([(2.34, 48.85, 2.36, 48.87)])
+
+    assert sorted(ids.tolist()) == recordedIds(server)
+    assert client.requests == -(-len(server.images) // 5)
+    assert client.truncated == 0
+    assert all('after=' in path for path in server.paths[1:])
+
+
+def test_fetch_tiles_splits_truncated_tiles(server):
+    client = MapillaryClient(TOKEN, server.url, page_size=8)
+    ids, lons, lats, dates = client.fetchTiles([(2.34, 48.85, 2.36, 48.87)])
+
+    assert sorted(ids.tolist()) == recordedIds(server)
+    assert client.requests > 1
+    assert client.truncated == 0
+
+
+def test_fetch_tiles_reports_tiles_still_truncated(server):
+    client = MapillaryClient(TOKEN, server.url, page_size=1)
+    client.MAX_SPLIT = 0
+    ids, lons, lats, dates = client.fetchTiles([(2.34, 48.85, 2.36, 48.87)])
+
+    assert len(ids) == 1
+    assert client.truncated == 1
+
+
+def test_fetch_retries_rate_limited_requests(server):
+    server.failures = [429, 503]
+    client = MapillaryClient(TOKEN, server.url)
+    ids, lons, lats, dates = client.fetchTiles([(2.34, 48.85, 2.36, 48.87)])
+
+    assert sorted(ids.tolist()) == recordedIds(server)
+    assert client.requests == 3
+
+
+def test_fetch_raises_on_client_errors(server):
+    client = MapillaryClient('wrong-token', server.url, max_retries=1)
+    with pytest.raises(RuntimeError, match='401'):
+        client.fetchTiles([(2.34, 48.85, 2.36, 48.87)])
+    assert client.requests == 1
+
+
+def test_responses_are_cached(server, tmp_path):
+    bboxes = [(2.34, 48.85, 2.35, 48.86), (2.35, 48.86, 2.36, 48.87)]
+    first = MapillaryClient(TOKEN, server.url, cache_dir=str(tmp_path))
+    expected = first.fetchTiles(bboxes)[0]
+
+    second = MapillaryClient(TOKEN, server.url, cache_dir=str(tmp_path))
+    ids = second.fetchTiles(bboxes)[0]
+    assert sorted(ids.tolist()) == sorted(expected.tolist())
+    assert second.requests == 0
+    assert second.cache_hits == 2
+
+
+def test_grid_index_matches_brute_force():
+    rng = np.random.default_rng(3)
+    img_lons = 2.35 + rng.random(500) * 0.01
+    img_lats = 48.85 + rng.random(500) * 0.01
+    lons = 2.35 + rng.random(300) * 0.01
+    lats = 48.85 + rng.random(300) * 0.01
+    index = ImageGridIndex(img_lons, img_lats, 15)
+
+    nearest, distances = index.nearest(lons, lats)
+
+    for k in range(len(lons)):
+        brute = index.distance(lons[k], lats[k], img_lons, img_lats)
+        if brute.min() <= 15:
+            assert nearest[k] == np.argmin(brute)
+            assert distances[k] == pytest.approx(brute.min())
+        else:
+            assert nearest[k] == -1
+
+
+@pytest.mark.parametrize('max_distance', [0, -5])
+def test_grid_index_requires_positive_distance(max_distance):
+    with pytest.raises(ValueError):
+        ImageGridIndex(np.zeros(1), np.zeros(1), max_distance)
+
+
+def test_covering_tiles_include_tiles_between_corners():
+    # 3 km, bien plus qu'une demi-tuile de 0.01°
+    tiles = coveringTiles(np.array([2.3522]), np.array([48.8566]), 3000, 0.01)
+
+    radius_lat = 3000 / 111320.0
+    radius_lon = radius_lat / np.cos(np.radians(48.8566))
+    xs = range(int(np.floor((2.3522 - radius_lon) / 0.01)), int(np.floor((2.3522 + radius_lon) / 0.01)) + 1)
+    ys = range(int(np.floor((48.8566 - radius_lat) / 0.01)), int(np.floor((48.8566 + radius_lat) / 0.01)) + 1)
+    assert len(xs) > 2 and len(ys) > 2
+    assert sorted(map(tuple, tiles.tolist())) == [(x, y) for x in xs for y in ys]
+
+
+def test_covering_tiles_of_close_points_are_merged():
+    lons = np.array([2.3505, 2.3506, 2.3595])
+    lats = np.array([48.8505, 48.8506, 48.8595])
+    tiles = coveringTiles(lons, lats, 10, 0.01)
+
+    assert tiles.tolist() == [[235, 4885]]
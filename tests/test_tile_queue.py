@@ -0,0 +1,84 @@
+"""
+Tests of the SQLite tile queue shared by Histogram Matching and its workers,
+with several worker processes claiming the same queue.
+"""
+
+import multiprocessing
+import time
+
+import tileQueue
+
+
+def createTiles(path, count):
+    tiles = [('tile_%d' % index, index, 0.0, index + 1.0, 1.0, 'tile_%d.tif' % index) for index in range(count)]
+    tileQueue.createQueue(path, {'output': 'out.vrt'}, tiles)
+
+
+def drain(queue_path, worker, results):
+    conn = tileQueue.connect(queue_path)
+    claimed = []
+    while True:
+        tile = tileQueue.claimTile(conn, worker, 60, 3)
+        if tile is None:
+            break
+        time.sleep(0.001)
+        if tileQueue.completeTile(conn, tile[0], worker):
+            claimed.append(tile[0])
+    conn.close()
+    results.put((worker, claimed))
+
+
+def test_worker_processes_claim_each_tile_once(tmp_path):
+    queue_path = str(tmp_path / 'queue.sqlite')
+    createTiles(queue_path, 200)
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    processes = [context.Process(target=drain, args=(queue_path, 'worker_%d' % index, results)) for index in range(4)]
+    for process in processes:
+        process.start()
+    claimed = dict(results.get(timeout=120) for process in processes)
+    for process in processes:
+        process.join(timeout=120)
+        assert process.exitcode == 0
+
+    tiles = sorted(tile for worker_tiles in claimed.values() for tile in worker_tiles)
+    assert tiles == list(range(1, 201))
+    conn = tileQueue.connect(queue_path)
+    assert tileQueue.countTiles(conn) == {'done': 200}
+    owners = dict(conn.execute('SELECT id, worker FROM tiles'))
+    for worker, worker_tiles in claimed.items():
+        assert all(owners[tile] == worker for tile in worker_tiles)
+    assert tileQueue.startFinalize(conn)
+    assert not tileQueue.startFinalize(conn)
+    conn.close()
+
+
+def test_expired_lease_is_claimed_again_until_max_attempts(tmp_path):
+    queue_path = str(tmp_path / 'queue.sqlite')
+    createTiles(queue_path, 1)
+    conn = tileQueue.connect(queue_path)
+
+    assert tileQueue.claimTile(conn, 'first', -1, 2)[0] == 1
+    assert tileQueue.claimTile(conn, 'second', -1, 2)[0] == 1
+    # deux essais épuisés : la dalle n'est plus reprise et passe en échec
+    assert tileQueue.claimTile(conn, 'third', 60, 2) is None
+    assert tileQueue.countTiles(conn) == {'failed': 1}
+    assert not tileQueue.startFinalize(conn)
+    conn.close()
+
+
+def test_lost_lease_does_not_complete_the_tile(tmp_path):
+    queue_path = str(tmp_path / 'queue.sqlite')
+    createTiles(queue_path, 1)
+    conn = tileQueue.connect(queue_path)
+
+    tileQueue.claimTile(conn, 'slow', -1, 3)
+    tileQueue.claimTile(conn, 'fast', 60, 3)
+    assert not tileQueue.completeTile(conn, 1, 'slow')
+    tileQueue.releaseTile(conn, 1, 'slow', 3, 'erreur')
+    assert conn.execute('SELECT status, worker, error FROM tiles').fetchone() == ('running', 'fast', None)
+
+    assert tileQueue.completeTile(conn, 1, 'fast')
+    assert tileQueue.countTiles(conn) == {'done': 1}
+    conn.close()
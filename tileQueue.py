@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+File de travail SQLite de l'exécution distribuée de 'Histogram Matching'.
+
+L'algorithme QGIS y publie les dalles avec createQueue, les workers les
+réservent avec un bail (claimTile) puis les terminent ou les relâchent. Une
+dalle dont le bail a expiré est reprise par un autre worker tant qu'elle n'a
+pas épuisé ses essais. Seule la bibliothèque standard est nécessaire.
+"""
+
+import json
+import os
+import sqlite3
+import time
+
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    return conn
+
+
+def createQueue(path, meta, tiles):
+    """
+    Creates the queue file with the meta dictionary and the pending tiles,
+    given as (name, xmin, ymin, xmax, ymax, path) tuples.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('CREATE TABLE state (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('CREATE TABLE tiles (id INTEGER PRIMARY KEY, name TEXT, xmin REAL, ymin REAL, xmax REAL, ymax REAL, '
+                     'path TEXT, status TEXT DEFAULT \'pending\', worker TEXT, lease_until REAL, attempts INTEGER DEFAULT 0, error TEXT)')
+        conn.executemany('INSERT INTO meta VALUES (?, ?)', [(key, json.dumps(value)) for (key, value) in meta.items()])
+        conn.execute("INSERT INTO state VALUES ('finalize', 'pending')")
+        conn.executemany('INSERT INTO tiles (name, xmin, ymin, xmax, ymax, path) VALUES (?, ?, ?, ?, ?, ?)', tiles)
+    conn.close()
+
+
+def readMeta(conn):
+    return dict((key, json.loads(value)) for (key, value) in conn.execute('SELECT key, value FROM meta'))
+
+
+def claimTile(conn, worker, lease, max_attempts):
+    """
+    Reserves a pending tile, or a tile whose lease has expired, for lease
+    seconds. Expired tiles that used up their max_attempts are marked
+    failed instead of being claimed again.
+    Returns (id, name, xmin, ymin, xmax, ymax, path) or None.
+    """
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute(
+            "UPDATE tiles SET status = 'failed', lease_until = NULL, error = coalesce(error, 'bail expiré') "
+            "WHERE status = 'running' AND lease_until < ? AND attempts >= ?", (now, max_attempts))
+        row = conn.execute(
+            "SELECT id, name, xmin, ymin, xmax, ymax, path FROM tiles "
+            "WHERE status = 'pending' OR (status = 'running' AND lease_until < ? AND attempts < ?) "
+            "ORDER BY id LIMIT 1", (now, max_attempts)).fetchone()
+        if row is not None:
+            conn.execute(
+                "UPDATE tiles SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                (worker, now + lease, row[0]))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return row
+
+
+def completeTile(conn, tile_id, worker):
+    """
+    Marks the tile done if worker still holds it. Returns False when the
+    lease was lost, the tile being then owned by another worker.
+    """
+    cursor = conn.execute(
+        "UPDATE tiles SET status = 'done', lease_until = NULL WHERE id = ? AND worker = ? AND status = 'running'",
+        (tile_id, worker))
+    return cursor.rowcount == 1
+
+
+def releaseTile(conn, tile_id, worker, max_attempts, error):
+    conn.execute(
+        "UPDATE tiles SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+        "lease_until = NULL, error = ? WHERE id = ? AND worker = ? AND status = 'running'",
+        (max_attempts, error, tile_id, worker))
+
+
+def countTiles(conn):
+    return dict(conn.execute('SELECT status, count(*) FROM tiles GROUP BY status'))
+
+
+def startFinalize(conn):
+    """
+    Returns True for the single caller allowed to build the VRT, once every
+    tile is done.
+    """
+    counts = countTiles(conn)
+    if counts.get('pending', 0) or counts.get('running', 0) or counts.get('failed', 0):
+        return False
+    cursor = conn.execute("UPDATE state SET value = 'running' WHERE key = 'finalize' AND value = 'pending'")
+    return cursor.rowcount == 1
+
+
+def endFinalize(conn):
+    conn.execute("UPDATE state SET value = 'done' WHERE key = 'finalize'")